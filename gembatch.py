@@ -0,0 +1,487 @@
+import numpy
+from gemengine import Board, PairCombiner, cell_dtype, activation_masks, compile_patterns, \
+	find_runs, resolve_conflicts, count_neighbors, unlock_neighbors, \
+	padded_colors, evaluate_swaps, collect_moves, random_integers, EventLog, landing_rows
+
+# Batched version of the game engine in gemengine.
+#
+# N boards of the same shape are stored as one (N, nrows, ncols) array.
+# Each game phase runs as one vectorized operation over all boards.
+# Every component takes an *active* mask of the boards to work on, so
+# cascades of different lengths can proceed in lockstep: boards which
+# have settled down simply drop out until their next move.
+#
+# The random numbers are drawn for all boards at once (from *rng*,
+# by default the numpy.random global state), so the games differ from
+# those of the single board engine. Where gemengine works through gems
+# one after the other, the batch components handle them simultaneously.
+
+class BoardBatch(object):
+	"""
+	Stack of game boards of the same shape.
+
+	*cells* is a packed record array of shape (nboards, nrows, ncols);
+	*type*, *color* and *status* are views into it, as for Board.
+	Each board has its own EventLog of events.
+	"""
+	def __init__(self, nboards, nrows=10, ncols=10):
+		self.shape = (nrows,ncols)
+		self.cells = numpy.zeros((nboards,) + self.shape, dtype=cell_dtype)
+		self.events = [EventLog() for k in range(nboards)]
+
+	type = property(lambda self: self.cells['type'])
+	color = property(lambda self: self.cells['color'])
+	status = property(lambda self: self.cells['status'])
+
+	@classmethod
+	def from_boards(cls, boards):
+		batch = cls(len(boards), *boards[0].shape)
+		for k, board in enumerate(boards):
+			batch.cells[k] = board.cells
+			batch.events[k] = board.events.copy()
+		return batch
+
+	def __len__(self):
+		return len(self.cells)
+
+	def board(self, k):
+		"""
+		Board k, as a Board sharing cells and events with the batch.
+		"""
+		board = Board.__new__(Board)
+		board.shape = self.shape
+		board.trackers = []
+		board.journal = None
+		board.set_cells(self.cells[k])
+		board.events = self.events[k]
+		return board
+
+	def selection(self, active=None):
+		"""
+		Boolean mask of the boards selected by *active* (default: all).
+		"""
+		if active is None:
+			return numpy.ones(len(self), dtype=bool)
+		return numpy.asarray(active, dtype=bool)
+
+	def touch(self, index):
+		# changes to batches are not tracked
+		pass
+
+	def record(self, event, counts):
+		"""
+		Add the event (event, count) to each board with a non-zero count.
+		"""
+		for k in numpy.flatnonzero(counts):
+			self.events[k].append((event, int(counts[k])))
+
+class BatchTopFiller(object):
+	"""
+	Refills the boards from the top, if there are empty fields
+	"""
+	def __init__(self, batch, ncolors, locked_empty_fraction=0.0, rng=None):
+		self.batch = batch
+		self.ncolors = ncolors
+		self.locked_empty_fraction = locked_empty_fraction
+		self.rng = numpy.random if rng is None else rng
+
+	def run(self, active=None):
+		"""
+		Returns which boards were changed.
+		"""
+		batch = self.batch
+		active = batch.selection(active)
+		fill = numpy.logical_and(numpy.logical_and(batch.type[:,0] == 0, batch.status[:,0] == 0), active.reshape((-1, 1)))
+		locked = self.rng.uniform(size=fill.shape) < self.locked_empty_fraction
+		color = 1 + random_integers(self.rng, self.ncolors, size=fill.shape)
+		n, i = numpy.where(numpy.logical_and(fill, locked))
+		# locked, colorless
+		batch.cells[n,0,i] = (0, 0, 1)
+		n, i = numpy.where(numpy.logical_and(fill, ~locked))
+		# normal, not locked, simple things
+		batch.type[n,0,i] = 1
+		batch.color[n,0,i] = color[n,i]
+		batch.status[n,0,i] = 0
+		return fill.any(axis=1)
+
+class BatchNastyTopFiller(BatchTopFiller):
+	"""
+	Refills the boards from the top, if there are empty fields.
+
+	Prefers not to use the color of neighbors of the empty field where
+	the gem would end up in (see gemengine.NastyTopFiller).
+	"""
+	def run(self, active=None):
+		batch = self.batch
+		nrows, ncols = batch.shape
+		active = batch.selection(active)
+		nboards = len(batch)
+		fill = numpy.logical_and(numpy.logical_and(batch.type[:,0] == 0, batch.status[:,0] == 0), active.reshape((-1, 1)))
+		if not fill.any():
+			return fill.any(axis=1)
+		locked = self.rng.uniform(size=fill.shape) < self.locked_empty_fraction
+		# find the row where each gem will end up
+		landing = landing_rows(batch.type, batch.status)
+		padded = padded_colors(batch)
+		boards = numpy.arange(nboards)
+		lastcolor = numpy.full(nboards, -1)
+		# columns are filled left to right, avoiding the previous color
+		for i in numpy.flatnonzero(fill.any(axis=0)):
+			j = landing[:,i]
+			bad_colors = numpy.array([lastcolor, padded[boards, 2+j, 3+i], padded[boards, 2+j, 1+i], padded[boards, 3+j, 2+i]])
+			# try twice to avoid these colors
+			tries = 1 + random_integers(self.rng, self.ncolors, size=(3, nboards))
+			bad = (tries.reshape((3, 1, nboards)) == bad_colors.reshape((1, 4, nboards))).any(axis=1)
+			color = numpy.where(bad[0], numpy.where(bad[1], tries[2], tries[1]), tries[0])
+
+			normal = numpy.logical_and(fill[:,i], ~locked[:,i])
+			n = numpy.flatnonzero(normal)
+			batch.type[n,0,i] = 1
+			batch.color[n,0,i] = color[n]
+			batch.status[n,0,i] = 0
+			padded[n,2,2+i] = color[n]
+			lastcolor[n] = color[n]
+			n = numpy.flatnonzero(numpy.logical_and(fill[:,i], locked[:,i]))
+			batch.cells[n,0,i] = (0, 0, 1)
+			padded[n,2,2+i] = 0
+		return fill.any(axis=1)
+
+class BatchGravityPuller(object):
+	"""
+	Makes gems fall down if there are empty fields below
+	"""
+	def __init__(self, batch, rng=None):
+		self.batch = batch
+		self.rng = numpy.random if rng is None else rng
+
+	def droppable_mask(self):
+		batch = self.batch
+		return numpy.logical_and(batch.type > 0,
+			numpy.logical_not(numpy.logical_and(batch.status > 0, batch.color > 0)))
+
+	def settle(self, active=None):
+		"""
+		Makes all gems fall as far as they can, see
+		gemengine.BoardGravityPuller.settle. Where two empty fields could
+		be filled diagonally from the same gem, the left one gets it.
+
+		Returns which boards were changed.
+		"""
+		batch = self.batch
+		nrows, ncols = batch.shape
+		active = batch.selection(active)
+		inactive = numpy.logical_not(active).reshape((-1, 1, 1))
+		moved = numpy.zeros(len(batch), dtype=bool)
+		rowidx = numpy.arange(nrows).reshape((1, -1, 1))
+		colidx = numpy.arange(ncols).reshape((1, -1))
+		while True:
+			empty = numpy.logical_and(batch.type == 0, batch.status == 0)
+			droppable = self.droppable_mask()
+			# fields of inactive boards stay where they are
+			fixed = numpy.logical_or(numpy.logical_not(numpy.logical_or(empty, droppable)), inactive)
+			# compact the column segments between fixed fields
+			segment = numpy.cumsum(fixed, axis=1)
+			key = segment * 3 + numpy.where(fixed, 0, numpy.where(empty, 1, 2))
+			idx = numpy.argsort(key, axis=1, kind='stable')
+			if (idx != rowidx).any():
+				moved |= (idx != rowidx).any(axis=(1,2))
+				batch.cells[...] = numpy.take_along_axis(batch.cells, idx, axis=1)
+				empty = numpy.take_along_axis(empty, idx, axis=1)
+				droppable = numpy.take_along_axis(droppable, idx, axis=1)
+
+			# empty fields below a blocker are filled diagonally
+			blocked = numpy.logical_and(empty[:,1:], numpy.logical_not(numpy.logical_or(empty[:,:-1], droppable[:,:-1])))
+			if not blocked[active].any():
+				break
+			slid = False
+			for j in range(nrows - 1, 0, -1):
+				target = numpy.logical_and(empty[:,j], numpy.logical_not(numpy.logical_or(empty[:,j-1], droppable[:,j-1])))
+				target &= active.reshape((-1, 1))
+				if not target.any():
+					continue
+				first = random_integers(self.rng, 2, size=target.shape) * 2 - 1
+				for d in first, -first:
+					source = numpy.clip(colidx + d, 0, ncols - 1)
+					# the neighbor has to be filled (supported)
+					ok = numpy.logical_and(target, colidx + d == source)
+					ok &= numpy.take_along_axis(droppable[:,j-1], source, axis=1)
+					ok &= numpy.take_along_axis(batch.type[:,j] > 0, source, axis=1)
+					# two fields wanting the same gem: the left one wins
+					ok[:,2:] &= numpy.logical_not(numpy.logical_and(d[:,2:] == -1, numpy.logical_and(ok[:,:-2], d[:,:-2] == 1)))
+					n, i = numpy.where(ok)
+					if len(n) == 0:
+						continue
+					s = source[n, i]
+					batch.cells[n,j,i] = batch.cells[n,j-1,s]
+					batch.cells[n,j-1,s] = 0
+					empty[n,j,i], droppable[n,j,i] = False, True
+					empty[n,j-1,s], droppable[n,j-1,s] = True, False
+					target[n,i] = False
+					moved[n] = True
+					slid = True
+			if not slid:
+				break
+		return moved
+
+class BatchActivater(object):
+	"""
+	When gems are marked for activation, explodes them based on their type
+
+	All gems marked on a board explode at the same time: a field hit
+	by several explosions is unlocked (or destroyed) by all of them at once.
+	If *chain* is set, special gems hit by an explosion are activated
+	in the same run, until the chain reaction is over.
+	"""
+	def __init__(self, batch, chain=False, rng=None):
+		self.batch = batch
+		self.chain = chain
+		self.rng = numpy.random if rng is None else rng
+		self.masks = activation_masks(batch.shape)
+
+	def run(self, active=None):
+		"""
+		Returns which boards were changed.
+		"""
+		batch = self.batch
+		nboards = len(batch)
+		rowmasks, colmasks, squaremasks, singlemasks = self.masks
+		active = batch.selection(active)
+		changed = numpy.zeros(nboards, dtype=bool)
+		todo = numpy.logical_and(batch.status == -1, active.reshape((-1, 1, 1)))
+		while todo.any():
+			n, j, i = numpy.where(todo)
+			types = batch.type[n,j,i].astype(int)
+			masks = numpy.zeros((len(n),) + batch.shape, dtype=bool)
+			for type, typemasks in (4, squaremasks), (3, colmasks), (2, rowmasks), (1, singlemasks):
+				masks[types == type] = typemasks[j[types == type], i[types == type]]
+			zappers = numpy.flatnonzero(types == 5)
+			if len(zappers) > 0:
+				# choose a random color present on the board, and mark those
+				colors = numpy.arange(1, 7).reshape((1, 1, -1))
+				present = (batch.color[n[zappers]].reshape((len(zappers), -1, 1)) == colors).any(axis=1)
+				npresent = present.sum(axis=1)
+				choice = random_integers(self.rng, numpy.maximum(npresent, 1))
+				color = numpy.where(npresent > 0, 1 + numpy.argmax(numpy.cumsum(present, axis=1) > choice.reshape((-1, 1)), axis=1), 1)
+				masks[zappers] = batch.color[n[zappers]] == color.reshape((-1, 1, 1))
+			for k in numpy.flatnonzero(types > 0):
+				batch.events[n[k]].append(('activated', int(types[k])))
+			# remove the activated gems
+			batch.cells[n,j,i] = 0
+			changed[n[types > 0]] = True
+
+			# number of explosions hitting each field
+			hits = numpy.zeros(batch.type.shape, dtype=int)
+			numpy.add.at(hits, n[types > 0], masks[types > 0])
+			status = batch.status
+			notlocked = numpy.logical_and(hits > 0, status == 0)
+			unlocked = numpy.where(status > 0, numpy.minimum(hits, status), 0)
+			status -= unlocked.astype(status.dtype)
+			batch.record('unlocked', unlocked.sum(axis=(1,2)))
+			simple = numpy.logical_and(notlocked, batch.type == 1)
+			batch.type[simple] = 0
+			batch.color[simple] = 0
+			batch.record('destroyed', simple.sum(axis=(1,2)))
+			# mark special ones for explosion
+			marked = numpy.logical_and(notlocked, batch.type > 1)
+			status[marked] = -1
+
+			# bombs, zappers and simple gems unlock their surroundings
+			surrounding = numpy.flatnonzero(numpy.logical_or(types == 1, types >= 4))
+			nneighbors = numpy.zeros(batch.type.shape, dtype=int)
+			numpy.add.at(nneighbors, n[surrounding], count_neighbors(masks[surrounding]))
+			decrease = numpy.where(status > 0, numpy.minimum(nneighbors, status), 0)
+			status -= decrease.astype(status.dtype)
+
+			todo = marked if self.chain else numpy.zeros_like(marked)
+		return changed
+
+class BatchCombiner(object):
+	"""
+	Collapses any gem sequences on the current boards,
+	see gemengine.Combiner.
+	"""
+	def __init__(self, batch, rng=None):
+		self.batch = batch
+		self.rng = numpy.random if rng is None else rng
+		self.patterns, self.maxrun = compile_patterns(batch.shape)
+		# last swap of each board, or -1
+		self.interactions = numpy.full((len(batch), 4), -1)
+
+	def set_last_interaction(self, k, fromj,fromi, toj,toi):
+		self.interactions[k] = fromj, fromi, toj, toi
+
+	def run(self, active=None):
+		"""
+		Returns which boards were changed.
+		"""
+		batch = self.batch
+		nboards = len(batch)
+		nrows, ncols = batch.shape
+		active = batch.selection(active)
+		matchable = numpy.logical_and(numpy.logical_and(batch.type > 0, batch.status == 0), active.reshape((-1, 1, 1)))
+		hruns, vruns = find_runs(batch.color, matchable, self.maxrun)
+		matches = []
+		for name, mask, Nmask, runs, offsets in self.patterns:
+			mrows, mcols = mask.shape
+			has_valid_results = numpy.ones((nboards, nrows - mrows + 1, ncols - mcols + 1), dtype=bool)
+			for direction, k, dj, di in runs:
+				found = hruns[k] if direction == 'H' else vruns[k]
+				has_valid_results &= found[:, dj:dj + nrows - mrows + 1, di:di + ncols - mcols + 1]
+			if not has_valid_results.any():
+				continue
+			# the color of the first run is the color of the pattern
+			_, _, cj, ci = runs[0]
+			n, rows, cols = numpy.where(has_valid_results)
+			colors = batch.color[n, rows + cj, cols + ci]
+			# cells covered by each placement, as flat batch indices
+			cells = ((n * nrows + rows) * ncols + cols).reshape((-1, 1)) + offsets.reshape((1, -1))
+			matches += zip([name] * len(n), colors.tolist(), cells)
+
+		changed = numpy.zeros(nboards, dtype=bool)
+		if matches:
+			# matches on different boards never overlap, so the conflicts
+			# of all boards can be resolved together
+			accepted = [matches[k] for k in resolve_conflicts([match[-1] for match in matches], nboards * nrows * ncols)]
+			mask = numpy.zeros(nboards * nrows * ncols, dtype=bool)
+			mask[numpy.concatenate([cells for _, _, cells in accepted])] = True
+			mask = mask.reshape(batch.type.shape)
+			changed = mask.any(axis=(1,2))
+
+			# explode these (activate or set to empty)
+			simple = numpy.logical_and(mask, batch.type == 1)
+			batch.type[simple] = 0
+			batch.record('destroyed', simple.sum(axis=(1,2)))
+			# mark for explosion
+			batch.status[numpy.logical_and(mask, batch.type > 1)] = -1
+			# surrounding, decreasing field status
+			unlock_neighbors(batch, mask)
+
+			cells = batch.cells.reshape((-1,))
+			for name, matched_color, matchcells in accepted:
+				self.place_special(cells, name, matched_color, matchcells)
+		self.interactions[active] = -1
+		return changed
+
+	def place_special(self, cells, name, matched_color, matchcells):
+		"""
+		If T.*|X4|X5, replace one field of the match (flat batch indices 
+		*matchcells*) with the special item of the right color.
+		"""
+		if not (name[1] == '4' or name[1] == '5' or name.startswith('T') or name.startswith('L')):
+			return
+		nrows, ncols = self.batch.shape
+		k, start = divmod(int(matchcells[0]), nrows * ncols)
+		# the preferred location is to, from or random otherwise
+		idx = matchcells[random_integers(self.rng, len(matchcells))]
+		# draw again to avoid replacing something
+		if cells['type'][idx] > 1:
+			idx = matchcells[random_integers(self.rng, len(matchcells))]
+		fromj, fromi, toj, toi = self.interactions[k]
+		for j, i in (toj, toi), (fromj, fromi):
+			if i >= 0 and (k * nrows + j) * ncols + i in matchcells:
+				idx = (k * nrows + j) * ncols + i
+				break
+		if name == 'H4':
+			cells[idx] = (2, matched_color, 0)
+		elif name == 'V4':
+			cells[idx] = (3, matched_color, 0)
+		elif name.startswith('T') or name.startswith('L'):
+			cells[idx] = (4, matched_color, 0)
+		elif name[1] == '5':
+			cells[idx] = (5, 0, 0)
+
+class BatchPairCombiner(object):
+	"""
+	Finds the valid moves of all boards at once, and swaps gems.
+	"""
+	def __init__(self, batch, rng=None):
+		self.batch = batch
+		self.rng = numpy.random if rng is None else rng
+
+	def valid_moves(self, active=None):
+		"""
+		Lists the valid moves of each board, see PairCombiner.valid_moves.
+
+		Returns a list with an (N, 5) int array for each active board,
+		and None for the others.
+		"""
+		batch = self.batch
+		nrows, ncols = batch.shape
+		active = batch.selection(active)
+		padded = padded_colors(batch)
+		tables = [evaluate_swaps(batch, padded, direction, 0, nrows, 0, ncols) for direction in (0, 1)]
+		return [collect_moves(batch.shape, [(special[k], typesum[k], score[k]) for special, typesum, score in tables])
+			if active[k] else None for k in range(len(batch))]
+
+	def run(self, k, fromj,fromi, toj,toi):
+		"""
+		Swap two gems on board k, see PairCombiner.run.
+		"""
+		PairCombiner(self.batch.board(k), rng=self.rng).run(fromj,fromi, toj,toi)
+
+	def shuffle(self, k, playable=False):
+		"""
+		Shuffle board k, see PairCombiner.shuffle.
+		"""
+		return PairCombiner(self.batch.board(k), rng=self.rng).shuffle(playable=playable)
+
+def play(batch, topfill, move_selector, maxswaps, rng=None):
+	"""
+	Play the games on all boards of the batch in lockstep, 
+	with maxswaps swaps each.
+
+	The moves are chosen with move_selector(board, moves), as in gemengine.
+	Returns the scores (totals of the score_columns) of each board
+	before each swap, as an array (nboards, maxswaps, number of scores).
+	"""
+	grav = BatchGravityPuller(batch, rng=rng)
+	comb = BatchCombiner(batch, rng=rng)
+	acto = BatchActivater(batch, chain=True, rng=rng)
+	paircomb = BatchPairCombiner(batch, rng=rng)
+	nboards = len(batch)
+	nswaps = numpy.zeros(nboards, dtype=int)
+	ncomb = numpy.zeros(nboards, dtype=int)
+	nshuffles = numpy.zeros(nboards, dtype=int)
+	scores = [[] for k in range(nboards)]
+	# boards which have not settled down yet
+	moving = numpy.ones(nboards, dtype=bool)
+	while True:
+		while moving.any():
+			# dropping phase
+			dropping = moving
+			while dropping.any():
+				grav.settle(dropping)
+				dropping = topfill.run(dropping)
+			# combining phase
+			changed = comb.run(moving)
+			changed |= acto.run(moving)
+			ncomb += changed
+			moving = changed
+		
+		if (ncomb > (nswaps + 1) * 40).any():
+			raise Exception('STOPPING TRIVIAL GAME')
+		if (nshuffles > 100).any():
+			raise Exception('STOPPING UNPLAYABLE GAME (many shuffles)')
+		playing = nswaps < maxswaps
+		if not playing.any():
+			break
+		# ok, the boards settled down now
+		for k, moves in enumerate(paircomb.valid_moves(playing)):
+			if moves is None:
+				continue
+			if len(moves) == 0:
+				# no moves left -- shuffle
+				nshuffles[k] += 1
+				paircomb.shuffle(k, playable=True)
+			else:
+				moves = [((fromj,fromi,toj,toi), score) for fromj,fromi,toj,toi,score in moves.tolist()]
+				move = move_selector(batch.board(k), moves)
+				scores[k].append(batch.events[k].scores())
+				paircomb.run(k, *move)
+				nswaps[k] += 1
+				comb.set_last_interaction(k, *move)
+		# combining phase right after the swap
+		comb.run(playing)
+		acto.run(playing)
+		moving = playing
+	return numpy.array(scores)
@@ -0,0 +1,758 @@
+import numpy
+from collections import defaultdict
+import gemengine
+from gemengine import Board, EventLog, compile_patterns, random_integers
+# the other move selectors work on any board
+from gemengine import best_move_selector, worst_move_selector, random_move_selector
+
+__all__ = ['popcount', 'iterbits', 'shift', 'BitBoard', 'unlock_neighbors', 'explode',
+	'TopFiller', 'NastyTopFiller', 'BoardGravityPuller', 'Activater', 'PairCombiner',
+	'compile_bitpatterns', 'Combiner', 'smart_move_selector',
+	'best_move_selector', 'worst_move_selector', 'random_move_selector']
+
+# Bitboard version of the game engine in gemengine.
+#
+# For each type, each color and each status value, the board keeps one
+# integer, whose bits mark the fields having that value. Matches, valid
+# moves, explosion masks and unlocking the neighbors become shifts and
+# bitwise ands/ors on a handful of integers.
+#
+# The components behave exactly like their gemengine counterparts,
+# including the random numbers they draw, so a game played with either
+# engine (and the same seed) ends up on the same board.
+
+def popcount(bits):
+	return bin(bits).count('1')
+
+def iterbits(bits):
+	"""
+	Indices of the bits set, in increasing order.
+	"""
+	while bits:
+		low = bits & -bits
+		yield low.bit_length() - 1
+		bits ^= low
+
+def shift(bits, offset):
+	"""
+	Move the bit at index k+offset to index k.
+	"""
+	return bits >> offset if offset >= 0 else bits << -offset
+
+class BitBoard(object):
+	"""
+	Game board, stored as bitboards.
+
+	Field j,i is bit j*stride+i. Every row is followed by three guard bits,
+	which are never set, so shifting by up to three columns does not wrap
+	into the neighboring row. Python integers have no fixed width,
+	so boards of any size work the same way.
+
+	*types*, *colors* and *statuses* are lists of bitboards, indexed
+	by value; type -1 and status -1 are the last entries.
+	"""
+	def __init__(self, nrows=10, ncols=10):
+		self.shape = (nrows,ncols)
+		self.stride = ncols + 3
+		self.rowbits = (1 << ncols) - 1
+		# first field of every row
+		self.colbits = 0
+		for j in range(nrows):
+			self.colbits |= 1 << (j * self.stride)
+		self.full = self.colbits * self.rowbits
+		self.types = [self.full] + [0] * 6
+		self.colors = [self.full] + [0] * 6
+		self.statuses = [self.full] + [0] * 3
+		self.events = EventLog()
+
+	@classmethod
+	def from_board(cls, board):
+		"""
+		Convert a gemengine.Board.
+		"""
+		b = cls(*board.shape)
+		for values, arr in (b.types, board.type), (b.colors, board.color), (b.statuses, board.status):
+			for value in range(len(values)):
+				if value == len(values) - 1 and values is not b.colors:
+					value = -1
+				values[value] = b.from_mask(arr == value)
+			assert sum(values) == b.full, ('values out of range', arr)
+		b.events = board.events.copy()
+		return b
+
+	def to_board(self):
+		"""
+		Convert to a gemengine.Board.
+		"""
+		board = Board(*self.shape)
+		for values, arr in (self.types, board.type), (self.colors, board.color), (self.statuses, board.status):
+			for value, bits in enumerate(values):
+				if value == len(values) - 1 and values is not self.colors:
+					value = -1
+				arr[self.to_mask(bits)] = value
+		board.events = self.events.copy()
+		return board
+
+	def from_mask(self, mask):
+		"""
+		Bitboard of the fields set in the boolean array *mask*.
+		"""
+		bits = 0
+		for j, i in zip(*numpy.where(mask)):
+			bits |= 1 << (int(j) * self.stride + int(i))
+		return bits
+
+	def to_mask(self, bits):
+		"""
+		Boolean array of the fields set in *bits*.
+		"""
+		mask = numpy.zeros(self.shape, dtype=bool)
+		for index in iterbits(bits):
+			mask[divmod(index, self.stride)] = True
+		return mask
+
+	def bit(self, j, i):
+		return 1 << (j * self.stride + i)
+
+	def rect(self, loj, hij, loi, hii):
+		"""
+		Bitboard of the fields loj<=j<hij, loi<=i<hii.
+		"""
+		rows = self.colbits & ((1 << (hij * self.stride)) - (1 << (loj * self.stride)))
+		return rows * (((1 << (hii - loi)) - 1) << loi)
+
+	def type_at(self, bit):
+		for value, bits in enumerate(self.types):
+			if bits & bit:
+				return value if value < 6 else -1
+
+	def color_at(self, bit):
+		for value, bits in enumerate(self.colors):
+			if bits & bit:
+				return value
+
+	def status_at(self, bit):
+		for value, bits in enumerate(self.statuses):
+			if bits & bit:
+				return value if value < 3 else -1
+
+	def set(self, bits, type=None, color=None, status=None):
+		"""
+		Set type, color and/or status of all fields in *bits*.
+		"""
+		notbits = ~bits
+		for values, value in (self.types, type), (self.colors, color), (self.statuses, status):
+			if value is None:
+				continue
+			for k in range(len(values)):
+				values[k] &= notbits
+			values[value] |= bits
+
+	def move(self, frombits, offset):
+		"""
+		Move the fields *frombits* by *offset* bits (down and/or right),
+		leaving empty fields behind. 
+		"""
+		tobits = frombits << offset
+		keep = ~(frombits | tobits)
+		for values in self.types, self.colors, self.statuses:
+			for k, bits in enumerate(values):
+				values[k] = (bits & keep) | ((bits & frombits) << offset)
+			values[0] |= frombits
+
+	def swap(self, abit, bbit):
+		both = abit | bbit
+		for values in self.types, self.colors, self.statuses:
+			for k, bits in enumerate(values):
+				if bits & both:
+					values[k] = (bits & ~both) | (bbit if bits & abit else 0) | (abit if bits & bbit else 0)
+
+	def copy(self):
+		b = BitBoard.__new__(BitBoard)
+		b.shape = self.shape
+		b.stride = self.stride
+		b.rowbits = self.rowbits
+		b.colbits = self.colbits
+		b.full = self.full
+		b.types = list(self.types)
+		b.colors = list(self.colors)
+		b.statuses = list(self.statuses)
+		b.events = self.events.copy()
+		return b
+
+	def assign(self, other):
+		"""
+		Make this board equal to *other*, in place.
+		"""
+		self.types[:] = other.types
+		self.colors[:] = other.colors
+		self.statuses[:] = other.statuses
+		self.events.assign(other.events)
+
+	def __eq__(self, other):
+		return self.shape == other.shape and self.types == other.types and \
+			self.colors == other.colors and self.statuses == other.statuses
+
+	def __str__(self):
+		return str(self.to_board())
+
+def unlock_neighbors(board, mask):
+	"""
+	Decrease the lock status of the fields next to the exploded fields.
+
+	Every field that is not in *mask* itself is unlocked by one level
+	for each of its (up to four) neighbors in *mask*.
+	Returns the number of levels unlocked.
+	"""
+	stride = board.stride
+	outside = board.full & ~mask
+	left, right = (mask >> 1) & outside, (mask << 1) & outside
+	up, down = (mask >> stride) & outside, (mask << stride) & outside
+	once = left | right | up | down
+	twice = (left & right) | (up & down) | ((left | right) & (up | down))
+	statuses = board.statuses
+	one = statuses[1] & once
+	two = statuses[2] & twice
+	half = statuses[2] & once & ~twice
+	statuses[0] |= one | two
+	statuses[1] = (statuses[1] & ~one) | half
+	statuses[2] &= ~(two | half)
+	return popcount(one) + 2 * popcount(two) + popcount(half)
+
+def explode(board, mask, clear_color):
+	"""
+	Decrease the status of the locked fields in *mask*, remove the
+	simple gems and mark the special gems for activation.
+
+	Returns the number of fields changed and the bitboard of the
+	marked gems.
+	"""
+	types, statuses = board.types, board.statuses
+	locked1, locked2 = mask & statuses[1], mask & statuses[2]
+	notlocked = mask & statuses[0]
+	statuses[0] |= locked1
+	statuses[1] = (statuses[1] & ~locked1) | locked2
+	statuses[2] &= ~locked2
+	nlocked = popcount(locked1 | locked2)
+	if nlocked:
+		board.events.append(('unlocked', nlocked))
+	simple = notlocked & types[1]
+	if clear_color:
+		board.set(simple, type=0, color=0)
+	else:
+		board.set(simple, type=0)
+	nsimple = popcount(simple)
+	if nsimple:
+		board.events.append(('destroyed', nsimple))
+	marked = notlocked & (types[2] | types[3] | types[4] | types[5])
+	statuses[0] &= ~marked
+	statuses[-1] |= marked
+	return nlocked + nsimple + popcount(marked), marked
+
+class TopFiller(object):
+	"""
+	Refills the board from the top, if there are empty fields
+	"""
+	def __init__(self, board, ncolors, locked_empty_fraction=0.0, rng=None):
+		self.board = board
+		self.ncolors = ncolors
+		self.locked_empty_fraction = locked_empty_fraction
+		self.rng = numpy.random if rng is None else rng
+	def run(self):
+		board = self.board
+		changed = []
+		for i in iterbits(board.types[0] & board.statuses[0] & board.rowbits):
+			if self.rng.uniform() < self.locked_empty_fraction:
+				# locked, colorless
+				board.set(1 << i, type=0, color=0, status=1)
+			else:
+				# normal, not locked, simple things
+				board.set(1 << i, type=1, color=1 + random_integers(self.rng, self.ncolors), status=0)
+			changed.append([0,i,'topfilled'])
+		return changed
+
+class NastyTopFiller(object):
+	"""
+	Refills the board from the top, if there are empty fields.
+
+	Prefers not to use the color of neighbors of the empty field where
+	the gem would end up in.
+	"""
+	def __init__(self, board, ncolors, locked_empty_fraction=0.0, rng=None):
+		self.board = board
+		self.ncolors = ncolors
+		self.locked_empty_fraction = locked_empty_fraction
+		self.rng = numpy.random if rng is None else rng
+	def run(self):
+		board = self.board
+		nrows, ncols = board.shape
+		stride = board.stride
+		changed = []
+		lastcolor = -1
+		for i in iterbits(board.types[0] & board.statuses[0] & board.rowbits):
+			if self.rng.uniform() < self.locked_empty_fraction:
+				# locked, colorless
+				board.set(1 << i, type=0, color=0, status=1)
+			else:
+				# find the offset where it will end up:
+				# count the empty fields down to the first double-locked one
+				column = board.colbits << i
+				locks = board.statuses[2] & column
+				j = (locks & -locks).bit_length() // stride if locks else nrows - 1
+				offset = popcount(board.types[0] & column & ((2 << (j * stride + i)) - 1))
+				j = offset - 1
+
+				# now we presume that it will end up there.
+				bad_colors = set([lastcolor])
+				if i+1<ncols:
+					bad_colors.add(board.color_at(board.bit(j,i+1)))
+				if i-1>=0:
+					bad_colors.add(board.color_at(board.bit(j,i-1)))
+				if j+1<nrows:
+					bad_colors.add(board.color_at(board.bit(j+1,i)))
+				# try twice to avoid these colors
+				color = 1 + random_integers(self.rng, self.ncolors)
+				if color in bad_colors:
+					color = 1 + random_integers(self.rng, self.ncolors)
+					if color in bad_colors:
+						color = 1 + random_integers(self.rng, self.ncolors)
+
+				lastcolor = color
+				board.set(1 << i, type=1, color=color, status=0)
+			changed.append([0,i,'topfilled'])
+		return changed
+
+class BoardGravityPuller(object):
+	"""
+	Makes gems fall down if there are empty fields below
+	"""
+	def __init__(self, board, rng=None):
+		self.board = board
+		self.rng = numpy.random if rng is None else rng
+
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
+		self.board = board
+
+	def droppable(self):
+		"""
+		Bitboard of the fields which can fall.
+		"""
+		board = self.board
+		# locked and colored -> frozen
+		frozen = (board.statuses[1] | board.statuses[2]) & ~board.colors[0]
+		# make sure not an empty/unusable field:
+		return board.full & ~(board.types[0] | board.types[-1] | frozen)
+
+	def run(self):
+		board = self.board
+		nrows, ncols = board.shape
+		stride = board.stride
+		# handle empty cells starting from below:
+		changed = []
+		for j in range(nrows - 1, 0, -1):
+			empty = board.types[0] & board.statuses[0] & (board.rowbits << (j * stride))
+			if not empty:
+				continue
+			# check if field above is filled (otherwise, empty fields
+			# next to it can be filled from the top-left or top-right)
+			above = (empty >> stride) & ~(board.types[0] & board.statuses[0])
+			droppable = self.droppable()
+			# falling straight down does not affect the other fields
+			# of this row, so these are moved all at once
+			falling = above & droppable
+			blocked = above & ~droppable
+			if falling:
+				board.move(falling, stride)
+				droppable = self.droppable()
+			moves = [(index + stride, 'dropped from top') for index in iterbits(falling)]
+			for index in iterbits(blocked):
+				index += stride
+				i = index - j * stride
+				left = random_integers(self.rng, 2) * 2 - 1
+				# down-left/down-right dropping is only allowed if
+				# the neighbor is filled (supported)
+				for d in left, -left:
+					if 0 <= i+d < ncols and droppable & (1 << (index - stride + d)) and \
+						not (1 << (index + d)) & (board.types[0] | board.types[-1]):
+						board.move(1 << (index - stride + d), stride - d)
+						droppable = self.droppable()
+						moves.append((index, 'dropped from top-left' if d == -1 else 'dropped from top-right'))
+						break
+			for index, move in sorted(moves):
+				changed.append([j, index - j * stride, move])
+		return changed
+
+class Activater(object):
+	"""
+	When gems are marked for activation, explodes them based on their type
+
+	If *chain* is set, special gems hit by an explosion are activated
+	in the same run, until the chain reaction is over. Otherwise
+	they are only marked for activation in the next run.
+	"""
+	def __init__(self, board, chain=False, rng=None):
+		self.chain = chain
+		self.rng = numpy.random if rng is None else rng
+		self.bind(board)
+
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
+		self.board = board
+
+	def run(self):
+		board = self.board
+		nrows, ncols = board.shape
+		todo = board.statuses[-1]
+		nchanged = 0
+		while todo:
+			indices = list(iterbits(todo))
+			idx = numpy.arange(len(indices))
+			self.rng.shuffle(idx)
+			# special gems marked for explosion while working through this list
+			todo = 0
+			for k in idx:
+				bit = 1 << indices[k]
+				j, i = divmod(indices[k], board.stride)
+				affects_surrounding = False
+				type = board.type_at(bit)
+				if type == 5:
+					# choose a random color and mark those for explosion
+					colors = [color for color in range(1, len(board.colors)) if board.colors[color]]
+					if len(colors) == 0:
+						color = 1
+					else:
+						color = self.rng.choice(colors)
+					mask = board.colors[color]
+					affects_surrounding = True
+				elif type == 4:
+					# explode 3x3
+					mask = board.rect(max(0, j-1), min(nrows, j+2), max(0, i-1), min(ncols, i+2))
+					affects_surrounding = True
+				elif type == 3:
+					# explode vertically
+					mask = board.rect(0, nrows, i, i+1)
+				elif type == 2:
+					# explode horizontally
+					mask = board.rect(j, j+1, 0, ncols)
+				elif type == 1:
+					# simply remove. But decrease surrounding status.
+					mask = bit
+					affects_surrounding = True
+				else:
+					continue
+
+				# remove this one
+				board.events.append(('activated', type))
+				board.set(bit, type=0, color=0, status=0)
+				n, marked = explode(board, mask, clear_color=True)
+				nchanged += n
+				if self.chain:
+					todo |= marked
+
+				if affects_surrounding:
+					# surrounding, decreasing field status
+					nchanged += unlock_neighbors(board, mask)
+		return nchanged > 0
+
+class PairCombiner(object):
+	"""
+	When two gems are swapped, takes the right action if they are special
+	"""
+	def __init__(self, board, rng=None):
+		self.board = board
+		self.rng = numpy.random if rng is None else rng
+
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
+		self.board = board
+
+	def activate(self, mask, frombit, tobit):
+		board = self.board
+		for bit in frombit, tobit:
+			type = board.type_at(bit)
+			if type > 1:
+				board.events.append(('activated', type))
+		# remove the two triggers
+		board.set(frombit | tobit, type=0, color=0, status=0)
+		# explode these (decrease field status, activate or set to empty)
+		explode(board, mask, clear_color=False)
+		# surrounding, decreasing field status
+		unlock_neighbors(board, mask)
+
+	def run(self, fromj,fromi, toj,toi):
+		# check if stripe+bomb, stripe+stripe, bomb+bomb,
+		# both have to be unlocked and filled
+		board = self.board
+		nrows, ncols = board.shape
+		frombit, tobit = board.bit(fromj, fromi), board.bit(toj, toi)
+		assert board.status_at(frombit) == 0, board.status_at(frombit)
+		assert board.status_at(tobit) == 0, board.status_at(tobit)
+		assert board.type_at(frombit) > 0, board.type_at(frombit)
+		assert board.type_at(tobit) > 0, board.type_at(tobit)
+
+		board.swap(frombit, tobit)
+
+		abit, bbit = frombit, tobit
+		if board.type_at(abit) > board.type_at(bbit):
+			# switch so that a contains the smaller type
+			abit, bbit = bbit, abit
+		atype, btype = board.type_at(abit), board.type_at(bbit)
+
+		if btype == 5 and atype == 5:
+			# zapper+zapper -> activate entire board
+			mask = board.full & board.statuses[0] & ~(board.types[0] | board.types[-1])
+			board.events.append(('combined', 55))
+			self.activate(mask, frombit, tobit)
+		elif btype == 5 and 1 <= atype <= 4:
+			# zapper+something -> change all of that color to bombs/stripe and activate them
+			mask = board.colors[board.color_at(abit)] & board.types[1] & board.statuses[0]
+			if atype == 4:
+				board.set(mask, type=4)
+				board.events.append(('combined', 54))
+			elif atype in [2,3]:
+				for index, type in zip(iterbits(mask), 2+random_integers(self.rng, 1, size=popcount(mask))):
+					board.set(1 << index, type=int(type))
+				board.events.append(('combined', 52))
+			elif atype == 1: # normal gem
+				# no change. just activate them.
+				board.events.append(('combined', 51))
+
+			self.activate(mask, frombit, tobit)
+		elif btype == 4 and atype == 4:
+			# bomb+bomb -> make 5x5 explosion
+			mask = board.rect(max(0, toj-2), min(nrows, toj+3), max(0, toi-2), min(ncols, toi+3))
+			self.activate(mask, frombit, tobit)
+			board.events.append(('combined', 44))
+		elif btype == 4 and 2 <= atype <= 3:
+			# bomb+stripe -> eliminate 3xvertical+horizontal from toj,toi
+			self.activate(board.rect(0, nrows, max(0, toi-1), min(ncols, toi+2)), frombit, tobit)
+			self.activate(board.rect(max(0, toj-1), min(nrows, toj+2), 0, ncols), frombit, tobit)
+			board.events.append(('combined', 42))
+		elif 2 <= btype <= 3 and 2 <= atype <= 3:
+			# stripe+stripe -> eliminate 1xvertical+horizontal from toj,toi
+			self.activate(board.rect(0, nrows, toi, toi+1), frombit, tobit)
+			self.activate(board.rect(toj, toj+1, 0, ncols), frombit, tobit)
+			board.events.append(('combined', 22))
+
+	def valid_moves(self):
+		"""
+		List the valid moves, see gemengine.PairCombiner.valid_moves.
+
+		Returns a list of (fromj, fromi, toj, toi, score), in the same
+		order as gemengine.
+		"""
+		board = self.board
+		nrows, ncols = board.shape
+		stride = board.stride
+		types, colors, statuses = board.types, board.colors, board.statuses
+		specials = types[2] | types[3] | types[4] | types[5]
+		gems = board.full & ~(types[0] | types[-1])
+		moves = []
+		for direction, (dj, di), checks in (0, (0, 1), [(0, gemengine.PairCombiner.HSWAP_LEFTCOLOR), (1, gemengine.PairCombiner.HSWAP_RIGHTCOLOR)]), \
+				(1, (1, 0), [(0, gemengine.PairCombiner.VSWAP_TOPCOLOR), (1, gemengine.PairCombiner.VSWAP_BOTTOMCOLOR)]):
+			# swaps with the right/lower neighbor, marked at the first field
+			step = dj * stride + di
+			unlocked = statuses[0] & (statuses[0] >> step)
+			special = (specials & (specials >> step)) | (types[5] & (types[1] >> step)) | (types[1] & (types[5] >> step))
+			special &= unlocked
+			normal = gems & (gems >> step) & unlocked & ~special
+			# can not swap gems of same color
+			for bits in colors:
+				normal &= ~(bits & (bits >> step))
+			# completed three-in-a-rows, for each of the 8 cases
+			completed = [0] * 8
+			for bits in colors:
+				for n, (moved, offsets) in enumerate(checks):
+					movedbits = shift(bits, moved * step) & normal
+					if not movedbits:
+						continue
+					for m, ((aj, ai), (bj, bi)) in enumerate(offsets):
+						completed[n * 4 + m] |= movedbits & shift(bits, aj * stride + ai) & shift(bits, bj * stride + bi)
+
+			for index in iterbits(special):
+				j, i = divmod(index, stride)
+				typesum = board.type_at(1 << index) + board.type_at(1 << (index + step))
+				# special combinations are listed first
+				moves.append((-typesum, (j * ncols + i) * 2 + direction, (j, i, j+dj, i+di, typesum)))
+			scores = defaultdict(int)
+			for found in completed:
+				for index in iterbits(found):
+					scores[index] += 1
+			for index, score in scores.items():
+				j, i = divmod(index, stride)
+				moves.append((-score, (1 + direction) * 2 * nrows * ncols + j * ncols + i, (j, i, j+dj, i+di, score)))
+
+		result = []
+		for _, _, (fromj, fromi, toj, toi, score) in sorted(moves):
+			result.append((fromj, fromi, toj, toi, score))
+			result.append((toj, toi, fromj, fromi, score))
+		return result
+
+	def enumerate_valid_moves_oneway(self):
+		for move in self.valid_moves()[::2]:
+			yield move
+
+	def enumerate_valid_moves(self):
+		# for each swap there is the reverse swap also possible,
+		# which makes a difference in special candies (existing or created)
+		for fromj,fromi,toj,toi,score in self.valid_moves():
+			yield (fromj,fromi,toj,toi),score
+
+	def shuffle(self):
+		board = self.board
+		indices = list(iterbits(board.statuses[0] & board.types[1]))
+		idx = numpy.arange(len(indices))
+		self.rng.shuffle(idx)
+		colors = [board.color_at(1 << index) for index in indices]
+		for k, color in zip(idx, colors):
+			board.set(1 << indices[k], color=color)
+
+def compile_bitpatterns(shape):
+	"""
+	Combiner patterns (see gemengine.compile_patterns), with the pattern
+	fields as bitboard, placed at the top left corner.
+	"""
+	stride = shape[1] + 3
+	patterns = []
+	patterns_compiled, maxrun = compile_patterns(shape)
+	for name, mask, Nmask, runs, offsets in patterns_compiled:
+		bits = 0
+		for j, i in zip(*numpy.where(mask)):
+			bits |= 1 << (int(j) * stride + int(i))
+		runs = [(direction, k, dj * stride + di) for direction, k, dj, di in runs]
+		patterns.append((name, bits, int(Nmask), runs))
+	return patterns, maxrun
+
+class Combiner(object):
+	"""
+	Collapses any gem sequences on the current board
+	"""
+	def __init__(self, board, rng=None):
+		self.rng = numpy.random if rng is None else rng
+		self.bind(board)
+		self.fromj, self.fromi = None, None
+		self.toj, self.toi = None, None
+
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
+		self.board = board
+		self.patterns, self.maxrun = compile_bitpatterns(board.shape)
+
+	def set_last_interaction(self, fromj,fromi, toj,toi):
+		self.fromj, self.fromi = fromj, fromi
+		self.toj, self.toi = toj, toi
+
+	def run(self):
+		board = self.board
+		stride = board.stride
+		types, colors, statuses = board.types, board.colors, board.statuses
+		matchable = statuses[0] & board.full & ~(types[0] | types[-1])
+		# runs of at least k same-colored gems, starting towards the right/bottom
+		runs = []
+		for color, bits in enumerate(colors):
+			bits &= matchable
+			hruns, vruns = {1: bits}, {1: bits}
+			for k in range(2, self.maxrun + 1):
+				hruns[k] = hruns[k-1] & (bits >> (k - 1))
+				vruns[k] = vruns[k-1] & (bits >> ((k - 1) * stride))
+				# every pattern contains three in a row
+				if k == 3 and not hruns[k] and not vruns[k]:
+					break
+			else:
+				runs.append((color, hruns, vruns))
+		if not runs:
+			self.fromj, self.fromi = None, None
+			self.toj, self.toi = None, None
+			return False
+
+		matches = []
+		for name, mask, Nmask, patternruns in self.patterns:
+			found = []
+			for color, hruns, vruns in runs:
+				placed = board.full
+				for direction, k, offset in patternruns:
+					placed &= (hruns[k] if direction == 'H' else vruns[k]) >> offset
+				if placed:
+					found += [(index, color) for index in iterbits(placed)]
+			for index, color in sorted(found):
+				matches.append((name, color, Nmask, mask << index))
+
+		# if two matches affect the same field, always choose the longer one
+		# see gemengine.resolve_conflicts
+		covered, covered_twice = {}, {}
+		for name, color, Nmask, mask in matches:
+			covered_twice[Nmask] = covered_twice.get(Nmask, 0) | (covered.get(Nmask, 0) & mask)
+			covered[Nmask] = covered.get(Nmask, 0) | mask
+		longer = {}
+		for Nmask in covered:
+			longer[Nmask] = 0
+			for N, bits in covered.items():
+				if N > Nmask:
+					longer[Nmask] |= bits
+		accepted = []
+		tied = []
+		for match in matches:
+			name, color, Nmask, mask = match
+			if mask & longer[Nmask]:
+				continue
+			if mask & covered_twice[Nmask]:
+				tied.append(match)
+			else:
+				accepted.append(match)
+		occupied = 0
+		for match in accepted:
+			occupied |= match[-1]
+		for match in tied:
+			if not match[-1] & occupied:
+				occupied |= match[-1]
+				accepted.append(match)
+
+		for name, matched_color, Nmask, mask in accepted:
+			# explode these (decrease field status, activate or set to empty)
+			explode(board, mask, clear_color=False)
+			# surrounding, decreasing field status
+			unlock_neighbors(board, mask)
+
+			# if T.*|X4|X5 replace one location in the pattern with the special item of the right color
+			if name[1] == '4' or name[1] == '5' or name.startswith('T') or name.startswith('L'):
+				# the preferred location is to, from or random otherwise
+				indices = list(iterbits(mask))
+				bit = 1 << indices[random_integers(self.rng, len(indices))]
+				# draw again to avoid replacing something
+				if board.type_at(bit) > 1:
+					bit = 1 << indices[random_integers(self.rng, len(indices))]
+
+				if self.toi is not None and mask & board.bit(self.toj, self.toi):
+					bit = board.bit(self.toj, self.toi)
+				elif self.fromi is not None and mask & board.bit(self.fromj, self.fromi):
+					bit = board.bit(self.fromj, self.fromi)
+				if name == 'H4':
+					board.set(bit, type=2, color=matched_color, status=0)
+				elif name == 'V4':
+					board.set(bit, type=3, color=matched_color, status=0)
+				elif name.startswith('T') or name.startswith('L'):
+					board.set(bit, type=4, color=matched_color, status=0)
+				elif name[1] == '5':
+					board.set(bit, type=5, color=0, status=0)
+
+		self.fromj, self.fromi = None, None
+		self.toj, self.toi = None, None
+
+		return len(accepted) > 0
+
+def smart_move_selector(board, moves, rng=None):
+	"""
+	gemengine.smart_move_selector, for a BitBoard (which is searched 
+	as a gemengine.Board, see gemsearch.LookaheadSearch).
+	"""
+	import gemsearch
+	return gemsearch.LookaheadSearch(depth=1, rng=rng)(board.to_board(), moves)
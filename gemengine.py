@@ -1,8 +1,8 @@
 import sys
+import json
+import functools
 import numpy
-import scipy.signal
-from numpy import random
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 
 
 # the player only has one move: connect two gems
@@ -52,62 +52,252 @@ field_status = {
 }
 
 
+# all cell properties fit into a signed byte, so a board is stored as
+# one packed array of cell records. Copying a board is a single memcpy.
+cell_dtype = numpy.dtype([('type', numpy.int8), ('color', numpy.int8), ('status', numpy.int8)])
+
+def random_integers(rng, high, size=None):
+	"""
+	Random integers 0 <= x < high from *rng*, which can be a 
+	numpy.random.Generator, a RandomState or the numpy.random module.
+	"""
+	if isinstance(rng, numpy.random.Generator):
+		return rng.integers(high, size=size)
+	return rng.randint(high, size=size)
+
+def spawn_rngs(seed, n):
+	"""
+	n independent random number generators (e.g. one per game), 
+	derived reproducibly from *seed*.
+	"""
+	return [numpy.random.default_rng(s) for s in numpy.random.SeedSequence(seed).spawn(n)]
+
+# what the games are scored by. The combined* columns count the
+# combinations of two special gems (e.g. 42: bomb and stripe).
+event_kinds = ['activated', 'unlocked', 'destroyed', 'combined']
+combined_codes = [22, 42, 44, 51, 52, 54, 55]
+score_columns = ['score', 'destroyed', 'unlocked', 'stripes', 'bombs', 'zappers'] + \
+	['combined%d' % code for code in combined_codes]
+
+class EventLog(object):
+	"""
+	What happened in a game: a sequence of events like ('activated', 4),
+	('destroyed', 12), ('unlocked', 2) or ('combined', 42).
+	
+	The running totals of the score_columns are updated as events
+	are appended, so scores() does not need to go through the history.
+	Only the last *history* events are kept (in fixed-size arrays); 
+	these can be iterated and indexed by their position in the game.
+	"""
+	def __init__(self, history=0):
+		self.totals = [0] * len(score_columns)
+		self.nevents = 0
+		self.history = history
+		self.kinds = numpy.zeros(history, dtype=numpy.int8)
+		self.values = numpy.zeros(history, dtype=numpy.int32)
+	
+	def append(self, event):
+		kind, value = event
+		value = int(value)
+		totals = self.totals
+		if kind == 'activated':
+			totals[0] += 10 * value
+			if value in (2,3):
+				totals[3] += 1
+			elif value == 4:
+				totals[4] += 1
+			elif value == 5:
+				totals[5] += 1
+		elif kind == 'unlocked':
+			totals[2] += value
+		elif kind == 'destroyed':
+			totals[0] += value
+			totals[1] += value
+		elif kind == 'combined':
+			totals[6 + combined_codes.index(value)] += 1
+		else:
+			raise ValueError('unknown event "%s"' % kind)
+		if self.history:
+			i = self.nevents % self.history
+			self.kinds[i] = event_kinds.index(kind)
+			self.values[i] = value
+		self.nevents += 1
+	
+	def scores(self):
+		"""
+		Totals of the score_columns, as a list.
+		"""
+		return list(self.totals)
+	
+	def __len__(self):
+		return self.nevents
+	
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(self.nevents))]
+		if index < 0:
+			index += self.nevents
+		if not max(0, self.nevents - self.history) <= index < self.nevents:
+			raise IndexError('event %d not kept (last %d of %d events are)' % (
+				index, self.history, self.nevents))
+		i = index % self.history
+		return event_kinds[self.kinds[i]], int(self.values[i])
+	
+	def __iter__(self):
+		# the events still kept
+		return iter(self[max(0, self.nevents - self.history):])
+	
+	def __eq__(self, other):
+		# compare the events both logs still have
+		start = self.nevents - min(self.history, other.history, self.nevents)
+		return self.totals == other.totals and self.nevents == other.nevents and \
+			self[start:] == other[start:]
+	
+	def copy(self):
+		log = EventLog.__new__(EventLog)
+		log.assign(self)
+		return log
+	
+	def assign(self, other):
+		"""
+		Make this log equal to *other*, in place.
+		"""
+		self.totals = list(other.totals)
+		self.nevents = other.nevents
+		self.history = other.history
+		self.kinds = other.kinds.copy()
+		self.values = other.values.copy()
+
 class Board(object):
-	def __init__(self, nrows=10, ncols=10):
+	"""
+	Game board.
+	
+	The cells are stored in the packed record array *cells*;
+	the *type*, *color* and *status* attributes are views into it.
+	Assigning to them writes into the packed array.
+	
+	Components announce the fields they are about to change
+	with touch(). Consumers can follow these changes with 
+	track_changes(). Between mark() and undo_to(), the previous 
+	contents of the touched fields are recorded in a journal, 
+	so that the changes can be reverted.
+	
+	What happens on the board is recorded in the EventLog *events*,
+	which keeps the last *history* events.
+	"""
+	def __init__(self, nrows=10, ncols=10, history=0):
 		self.shape = (nrows,ncols)
-		self.type = numpy.zeros(self.shape, dtype=int)
-		self.color = numpy.zeros(self.shape, dtype=int)
-		self.status = numpy.zeros(self.shape, dtype=int)
-		self.events = []
+		self.trackers = []
+		self.journal = None
+		self.set_cells(numpy.zeros(self.shape, dtype=cell_dtype))
+		self.events = EventLog(history)
+	
+	def set_cells(self, cells):
+		self.touch(Ellipsis)
+		self.cells = cells
+		self._type = cells['type']
+		self._color = cells['color']
+		self._status = cells['status']
+	
+	def _set_type(self, value):
+		self.touch(Ellipsis)
+		self._type[...] = value
+	
+	def _set_color(self, value):
+		self.touch(Ellipsis)
+		self._color[...] = value
+	
+	def _set_status(self, value):
+		self.touch(Ellipsis)
+		self._status[...] = value
+	
+	type = property(lambda self: self._type, _set_type)
+	color = property(lambda self: self._color, _set_color)
+	status = property(lambda self: self._status, _set_status)
+	
+	def touch(self, index):
+		"""
+		Announce that the fields at *index* (anything that can index
+		a board array) are about to be changed.
+		"""
+		for dirty in self.trackers:
+			dirty[index] = True
+		if self.journal is not None:
+			if isinstance(index, numpy.ndarray):
+				index = index.copy()
+			self.journal.append((index, self.cells[index].copy()))
+	
+	def mark(self):
+		"""
+		Start journaling the changes to the board (if not done already).
+		
+		Returns a mark, to which undo_to() can revert the board.
+		"""
+		if self.journal is None:
+			self.journal = []
+		return len(self.journal), self.events.copy()
+	
+	def undo_to(self, mark):
+		"""
+		Revert the changes made since mark() returned *mark*.
+		The trackers see the reverted fields as changed.
+		"""
+		n, events = mark
+		journal = self.journal
+		while len(journal) > n:
+			index, cells = journal.pop()
+			for dirty in self.trackers:
+				dirty[index] = True
+			self.cells[index] = cells
+		self.events.assign(events)
+	
+	def stop_journal(self):
+		"""
+		Stop journaling; the changes can not be reverted any more.
+		"""
+		self.journal = None
+	
+	def track_changes(self):
+		"""
+		Start following changes to the board.
+		
+		Returns a boolean array, in which every touched field is
+		set to True. The consumer resets it after processing the changes,
+		and passes it to untrack() when done.
+		Initially, all fields are marked as changed.
+		"""
+		dirty = numpy.ones(self.shape, dtype=bool)
+		self.trackers.append(dirty)
+		return dirty
+	
+	def untrack(self, dirty):
+		self.trackers = [d for d in self.trackers if d is not dirty]
 	
 	def copy(self):
-		nrows,ncols = self.shape
-		b = Board(nrows=nrows,ncols=ncols)
-		b.type = self.type.copy()
-		b.color = self.color.copy()
-		b.status = self.status.copy()
-		b.events = list(self.events)
+		b = Board.__new__(Board)
+		b.shape = self.shape
+		b.trackers = []
+		b.journal = None
+		b.set_cells(self.cells.copy())
+		b.events = self.events.copy()
 		return b
 	
+	def assign(self, other):
+		"""
+		Make this board equal to *other*, in place.
+		"""
+		self.touch(self.cells != other.cells)
+		self.cells[...] = other.cells
+		self.events.assign(other.events)
+	
 	def __eq__(self, other):
 		return self.shape == other.shape and \
-			(self.type == other.type).all() and \
-			(self.color == other.color).all() and \
-			(self.status == other.status).all()
+			(self.cells == other.cells).all()
 	
 	def __str__(self):
-		#return 'BOARD:'
-		t = 'BOARD: %dx%d\n' % (self.type.shape)
-		for rowtype, rowcolor, rowstatus in zip(self.type, self.color, self.status):
-			for type, color, status in zip(rowtype, rowcolor, rowstatus):
-				if type == -1:
-					t += ' X'
-				elif type == 0:
-					if status == 2:
-						t += ' B'
-					elif status == 1:
-						t += ' b'
-					else:
-						t += '  '
-				elif type == 1:
-					t += ' %d' % color
-				elif type == 2:
-					t += '=%d' % color
-				elif type == 3:
-					t += '|%d' % color
-				elif type == 4:
-					t += 'X%d' % color
-				elif type == 5:
-					t += '# '
-				if status == 2:
-					s = 'L'
-				elif status == 1:
-					s = 'l'
-				else:
-					s = ' '
-				t += '%s ' % s
-			t += '\n'
-		return t
+		# the text format is defined in gemtext
+		import gemtext
+		return gemtext.format_board(self)
 
 class InitialFiller(object):
 	"""
@@ -170,6 +360,7 @@ class InitialFillerDoubleLock(InitialFiller):
 	Fills with double-locked, useless blocks
 	"""
 	def apply(self, rows, cols):
+		self.board.touch((rows, cols))
 		self.board.status[rows, cols] = 2
 		self.board.color[rows, cols] = 0
 		self.board.type[rows, cols] = 0
@@ -179,6 +370,7 @@ class InitialFillerDisable(InitialFiller):
 	Removes fields
 	"""
 	def apply(self, rows, cols):
+		self.board.touch((rows, cols))
 		self.board.type[rows, cols] = -1
 		self.board.color[rows, cols] = 0
 
@@ -196,26 +388,74 @@ class InitialFillerDoubleLockSpecial(InitialFiller):
 		
 	def apply(self, rows, cols):
 		selshape = self.board.status[rows, cols].shape
+		self.board.touch((rows, cols))
 		self.board.status[rows, cols] = 2
 		self.board.type[rows, cols] = self.rng.choice(self.types, size=selshape)
 		self.board.color[rows, cols] = 1 + self.rng.randint(self.ncolors, size=selshape)
 	
+def refill_columns(board, rng, locked_empty_fraction, choose_color):
+	"""
+	Fill all empty fields at the top of each column in one go.
+	
+	The gems come in one after the other, and fall as far as they can.
+	As when filling the top row, each is a locked colorless field with 
+	probability locked_empty_fraction. Such a field stays in the top row
+	and closes the column. choose_color(j, i) gives the color of a gem 
+	ending up at j,i.
+	
+	Returns a list of [j, i, 'topfilled', fromj, fromi] for each new 
+	field. All new gems of a column fall by the same distance, so fromj
+	is above the board (negative).
+	"""
+	empty = numpy.logical_and(board.type == 0, board.status == 0)
+	# number of empty fields from the top, in each column
+	nholes = numpy.cumprod(empty, axis=0).sum(axis=0)
+	changed = []
+	for i in numpy.flatnonzero(nholes).tolist():
+		k = int(nholes[i])
+		for j in range(k - 1, -1, -1):
+			if rng.uniform() < locked_empty_fraction:
+				# locked, colorless
+				board.touch((0,i))
+				board.type[0,i] = 0
+				board.color[0,i] = 0
+				board.status[0,i] = 1
+				changed.append([0,i,'topfilled',-1,i])
+				break
+			color = choose_color(j, i)
+			board.touch((j,i))
+			board.type[j,i] = 1
+			board.color[j,i] = color
+			board.status[j,i] = 0
+			changed.append([j,i,'topfilled',j-k,i])
+	return changed
+
 class TopFiller(object):
 	"""
-	Refills the board from the top, if there are empty fields
+	Refills the board from the top, if there are empty fields.
+	
+	Normally, only the top row is filled, and the gems are then
+	pulled down by gravity. With whole_columns=True, all empty fields 
+	at the top of each column are filled at once (see refill_columns).
 	"""
-	def __init__(self, board, ncolors, locked_empty_fraction=0.0):
+	def __init__(self, board, ncolors, locked_empty_fraction=0.0, rng=None, whole_columns=False):
 		self.board = board
 		self.ncolors = ncolors
 		self.locked_empty_fraction = locked_empty_fraction
+		self.rng = numpy.random if rng is None else rng
+		self.whole_columns = whole_columns
 	def run(self):
+		if self.whole_columns:
+			return refill_columns(self.board, self.rng, self.locked_empty_fraction, 
+				lambda j, i: 1 + random_integers(self.rng, self.ncolors))
 		board = self.board
 		nrows, ncols = board.shape
 		changed = []
 		# handle empty cells:
 		for i in range(ncols):
 			if board.type[0,i] == 0 and board.status[0,i] == 0:
-				if random.uniform() < self.locked_empty_fraction:
+				board.touch((0,i))
+				if self.rng.uniform() < self.locked_empty_fraction:
 					# locked, colorless
 					board.type[0,i] = 0
 					board.color[0,i] = 0
@@ -223,7 +463,7 @@ class TopFiller(object):
 				else:
 					# normal, not locked, simple things
 					board.type[0,i] = 1
-					board.color[0,i] = 1 + random.randint(self.ncolors)
+					board.color[0,i] = 1 + random_integers(self.rng, self.ncolors)
 					board.status[0,i] = 0
 				changed.append([0,i,'topfilled'])
 		return changed
@@ -233,72 +473,90 @@ class NastyTopFiller(object):
 	Refills the board from the top, if there are empty fields.
 	
 	Prefers not to use the color of neighbors of the empty field where
-	the gem would end up in.
+	the gem would end up in. whole_columns is as for TopFiller.
 	"""
-	def __init__(self, board, ncolors, locked_empty_fraction=0.0):
+	def __init__(self, board, ncolors, locked_empty_fraction=0.0, rng=None, whole_columns=False):
 		self.board = board
 		self.ncolors = ncolors
 		self.locked_empty_fraction = locked_empty_fraction
-	def run(self):
+		self.rng = numpy.random if rng is None else rng
+		self.whole_columns = whole_columns
+	
+	def choose_color(self, bad_colors):
+		# try twice to avoid the bad colors
+		color = 1 + random_integers(self.rng, self.ncolors)
+		if color in bad_colors:
+			color = 1 + random_integers(self.rng, self.ncolors)
+			if color in bad_colors:
+				color = 1 + random_integers(self.rng, self.ncolors)
+		return color
+	
+	def run_columns(self):
 		board = self.board
 		nrows, ncols = board.shape
-		changed = []
-		# handle empty cells:
+		lastcolor = [-1]
+		def choose_color(j, i):
+			# the neighbors are final here, or filled already
+			bad_colors = (lastcolor[0], board.color[j,i+1] if i+1<ncols else -1,
+				board.color[j,i-1] if i>0 else -1, board.color[j+1,i] if j+1<nrows else -1)
+			lastcolor[0] = self.choose_color(bad_colors)
+			return lastcolor[0]
+		return refill_columns(board, self.rng, self.locked_empty_fraction, choose_color)
+	
+	def run(self):
+		if self.whole_columns:
+			return self.run_columns()
+		board = self.board
+		# empty fields in the top row
+		columns = numpy.flatnonzero(numpy.logical_and(board.type[0] == 0, board.status[0] == 0))
+		if len(columns) == 0:
+			return []
+		# where the gems will end up, and the colors of the neighbors there
+		landing = landing_rows(board.type, board.status)[columns]
+		padded = padded_colors(board)
+		neighbors = numpy.transpose([columns, landing, padded[2+landing, 3+columns], 
+			padded[2+landing, 1+columns], padded[3+landing, 2+columns]]).tolist()
+		types, colors, statuses = [], [], []
 		lastcolor = -1
-		for i in range(ncols):
-			if board.type[0,i] == 0 and board.status[0,i] == 0:
-				if random.uniform() < self.locked_empty_fraction:
-					# locked, colorless
-					board.type[0,i] = 0
-					board.color[0,i] = 0
-					board.status[0,i] = 1
-				else:
-					# normal, not locked, simple things
-					# find the offset where it will end up
-					# go down and count until a locked one is found
-					mask = board.status[:,i] == 2
-					j = 0
-					for jnext in range(len(mask)):
-						if mask[j]: break
-						j = jnext
-					# count the number of empty ones until there
-					mask = numpy.logical_and(board.type[:,i] == 0, board.status[0,i] == 0)
-					offset = mask[:j+1].sum()
-					j = offset - 1
-					
-					# now we presume that it will end up there.
-					bad_colors = set([lastcolor])
-					if i+1<ncols:
-						bad_colors.add(board.color[j,i+1])
-					if i-1>=0:
-						bad_colors.add(board.color[j,i-1])
-					if j+1<nrows:
-						bad_colors.add(board.color[j+1,i])
-					#if i==1:
-					#	print('topfill should avoid colors:', bad_colors)
-					# try twice to avoid these colors
-					color = 1 + random.randint(self.ncolors)
-					if color in bad_colors:
-						color = 1 + random.randint(self.ncolors)
-						if color in bad_colors:
-							color = 1 + random.randint(self.ncolors)
-					
-					lastcolor = color
-					#print('setting lastcolor:', lastcolor)
-					board.type[0,i] = 1
-					board.color[0,i] = color
-					board.status[0,i] = 0
-				changed.append([0,i,'topfilled'])
-		return changed
+		for i, j, right, left, below in neighbors:
+			# the left neighbor may just have been filled
+			if j == 0 and colors and columns[len(colors) - 1] == i - 1:
+				left = colors[-1]
+			if self.rng.uniform() < self.locked_empty_fraction:
+				# locked, colorless
+				types.append(0)
+				colors.append(0)
+				statuses.append(1)
+			else:
+				# normal, not locked, simple things
+				color = self.choose_color((lastcolor, right, left, below))
+				lastcolor = color
+				types.append(1)
+				colors.append(color)
+				statuses.append(0)
+		board.touch((0, columns))
+		board.type[0,columns] = types
+		board.color[0,columns] = colors
+		board.status[0,columns] = statuses
+		return [[0,i,'topfilled'] for i in columns.tolist()]
 
 class BoardGravityPuller(object):
 	"""
 	Makes gems fall down if there are empty fields below
 	"""
-	def __init__(self, board):
+	def __init__(self, board, rng=None):
+		self.board = board
+		self.rng = numpy.random if rng is None else rng
+	
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
 		self.board = board
 	
 	def drop(self, fromj,fromi, toj,toi):
+		self.board.touch((fromj, fromi))
+		self.board.touch((toj, toi))
 		self.board.type[toj, toi] = self.board.type[fromj, fromi]
 		self.board.color[toj, toi] = self.board.color[fromj, fromi]
 		self.board.status[toj, toi] = self.board.status[fromj, fromi]
@@ -335,7 +593,7 @@ class BoardGravityPuller(object):
 						self.drop(j-1,i,j,i)
 						changed.append([j,i,'dropped from top'])
 						continue
-					left = random.randint(2) * 2 - 1
+					left = random_integers(self.rng, 2) * 2 - 1
 					right = -left
 					assert left in [-1,1], left
 					assert right in [-1,1], right
@@ -354,116 +612,360 @@ class BoardGravityPuller(object):
 						#print 'not dropping to', j,i,',',board.type[j,i+left],board.type[j,i+right]
 						
 		return changed
+	
+	def droppable_mask(self):
+		"""
+		Vectorized version of is_droppable for the entire board.
+		"""
+		board = self.board
+		return numpy.logical_and(board.type > 0, 
+			numpy.logical_not(numpy.logical_and(board.status > 0, board.color > 0)))
+	
+	def settle(self):
+		"""
+		Makes all gems fall as far as they can, in one call.
+		
+		The result is a board on which run() changes nothing:
+		Gems fall straight down through empty fields. An empty field
+		below a blocker (a non-field, a lock or a locked colored gem) is
+		filled from the top-left or top-right, if that neighbor can drop
+		and the field next to the empty one is filled.
+		Columns are compacted in a single vectorized step; only the
+		(rare) diagonal slides are handled cell by cell.
+		
+		Returns a list of [j, i, move, fromj, fromi], for each gem that 
+		moved, with the new position and where it came from.
+		"""
+		board = self.board
+		nrows, ncols = board.shape
+		rowidx = numpy.arange(nrows).reshape((-1, 1))
+		# for each gem, the flat index of the field it started in
+		origin = numpy.arange(nrows * ncols).reshape(board.shape)
+		while True:
+			empty = numpy.logical_and(board.type == 0, board.status == 0)
+			droppable = self.droppable_mask()
+			fixed = numpy.logical_not(numpy.logical_or(empty, droppable))
+			# columns are split into segments by fixed fields.
+			# Within a segment, the empty fields go to the top and the gems,
+			# keeping their order, to the bottom.
+			segment = numpy.cumsum(fixed, axis=0)
+			key = segment * 3 + numpy.where(fixed, 0, numpy.where(empty, 1, 2))
+			idx = numpy.argsort(key, axis=0, kind='stable')
+			if (idx != rowidx).any():
+				board.touch(idx != rowidx)
+				board.cells[...] = numpy.take_along_axis(board.cells, idx, axis=0)
+				origin = numpy.take_along_axis(origin, idx, axis=0)
+				empty = numpy.take_along_axis(empty, idx, axis=0)
+				droppable = numpy.take_along_axis(droppable, idx, axis=0)
+			
+			# now empty fields are either below an empty field or
+			# below a blocker. The latter can be filled diagonally.
+			slide = numpy.zeros(board.shape, dtype=bool)
+			slide[1:,:] = numpy.logical_and(empty[1:,:], numpy.logical_not(numpy.logical_or(empty[:-1,:], droppable[:-1,:])))
+			changed = False
+			for j, i in zip(*numpy.where(slide[::-1])):
+				j = nrows - 1 - j
+				left = random_integers(self.rng, 2) * 2 - 1
+				for d in left, -left:
+					if 0 <= i+d < ncols and self.is_droppable(j-1,i+d) and board.type[j,i+d] > 0:
+						self.drop(j-1,i+d,j,i)
+						origin[j,i] = origin[j-1,i+d]
+						changed = True
+						break
+			if not changed:
+				break
+		
+		changes = []
+		gems = numpy.logical_and(self.droppable_mask(), origin != numpy.arange(nrows * ncols).reshape(board.shape))
+		for j, i in zip(*numpy.where(gems[::-1])):
+			j = nrows - 1 - j
+			fromj, fromi = divmod(int(origin[j,i]), ncols)
+			if fromi < i:
+				move = 'dropped from top-left'
+			elif fromi > i:
+				move = 'dropped from top-right'
+			else:
+				move = 'dropped from top'
+			changes.append([j, i, move, fromj, fromi])
+		return changes
+
+def count_neighbors(mask):
+	"""
+	For every field not in *mask*, the number of its (up to four) 
+	neighbors in *mask*. 
+	
+	*mask* may have leading dimensions, for a stack of boards.
+	"""
+	mask = numpy.asarray(mask, dtype=bool)
+	nneighbors = numpy.zeros(mask.shape, dtype=int)
+	nneighbors[...,1:,:] += mask[...,:-1,:]
+	nneighbors[...,:-1,:] += mask[...,1:,:]
+	nneighbors[...,:,1:] += mask[...,:,:-1]
+	nneighbors[...,:,:-1] += mask[...,:,1:]
+	nneighbors[mask] = 0
+	return nneighbors
+
+def unlock_neighbors(board, mask):
+	"""
+	Decrease the lock status of the fields next to the exploded fields.
+	
+	Every field that is not in *mask* itself is unlocked by one level
+	for each of its (up to four) neighbors in *mask*.
+	Returns the number of levels unlocked.
+	"""
+	nneighbors = count_neighbors(mask)
+	status = board.status
+	decrease = numpy.where(status > 0, numpy.minimum(nneighbors, status), 0)
+	board.touch(decrease > 0)
+	status -= decrease.astype(status.dtype)
+	return decrease.sum()
+
+@functools.lru_cache(maxsize=16)
+def activation_masks(shape):
+	"""
+	Precomputed explosion masks for boards of the given shape.
+	
+	Returns boolean arrays of shape (nrows, ncols, nrows, ncols). 
+	Indexed with [j,i], they give the row, the column, the 3x3 square
+	and the single field affected by an activation at j,i.
+	"""
+	nrows, ncols = shape
+	rows = numpy.zeros((nrows, ncols, nrows, ncols), dtype=bool)
+	cols = numpy.zeros((nrows, ncols, nrows, ncols), dtype=bool)
+	squares = numpy.zeros((nrows, ncols, nrows, ncols), dtype=bool)
+	singles = numpy.zeros((nrows, ncols, nrows, ncols), dtype=bool)
+	for j in range(nrows):
+		for i in range(ncols):
+			rows[j,i,j,:] = True
+			cols[j,i,:,i] = True
+			squares[j,i,max(0, j-1):min(nrows, j+2),max(0, i-1):min(ncols, i+2)] = True
+			singles[j,i,j,i] = True
+	for masks in rows, cols, squares, singles:
+		masks.flags.writeable = False
+	return rows, cols, squares, singles
 
 class Activater(object):
 	"""
 	When gems are marked for activation, explodes them based on their type
+	
+	If *chain* is set, special gems hit by an explosion are activated
+	in the same run, until the chain reaction is over. Otherwise
+	they are only marked for activation in the next run.
 	"""
-	def __init__(self, board):
+	def __init__(self, board, chain=False, rng=None):
+		self.chain = chain
+		self.rng = numpy.random if rng is None else rng
+		self.bind(board)
+	
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
 		self.board = board
+		self.masks = activation_masks(board.shape)
 	
 	def run(self):
 		mask = self.board.status == -1
-		nrows, ncols = self.board.shape
-		rows, cols = numpy.where(mask)
+		rowmasks, colmasks, squaremasks, singlemasks = self.masks
+		todo_rows, todo_cols = numpy.where(mask)
 		changed = False
 		nchanged = 0
 		#print 'candidates for activation:'
 		#print mask*1
-		idx = numpy.arange(len(rows))
-		numpy.random.shuffle(idx)
-		for j, i in zip(rows[idx], cols[idx]):
-			# deal with that one
-			#print j,i, j.shape,i.shape
-			affects_surrounding = False
-			type = self.board.type[j,i]
-			if type == 5:
-				# choose a random color and mark those for explosion
-				colors = numpy.unique(self.board.color)
-				if len(colors[colors > 0]) == 0:
-					color = 1
-				else:
-					color = numpy.random.choice(colors[colors > 0])
-				mask = self.board.color == color
-				affects_surrounding = True
-			elif type == 4:
-				# explode 3x3
-				loj, hij = max(0, j-1), min(nrows, j+2)
-				loi, hii = max(0, i-1), min(ncols, i+2)
-				mask = numpy.zeros(self.board.shape, dtype=bool)
-				mask[loj:hij,loi:hii] = True
-				affects_surrounding = True
-			elif type == 3:
-				# explode vertically
-				mask = numpy.zeros(self.board.shape, dtype=bool)
-				mask[Ellipsis,i] = True
-			elif type == 2:
-				# explode horizontally
-				mask = numpy.zeros(self.board.shape, dtype=bool)
-				mask[j,Ellipsis] = True
-			elif type == 1:
-				# simply remove. 
-				mask = numpy.zeros(self.board.shape, dtype=bool)
-				mask[j,i] = True
-				# But decrease surrounding status.
-				affects_surrounding = True
-			elif type == 0:
-				continue
-			
-			#print mask*1, 'activating, type %d' % type
-			# remove this one
-			self.board.events.append(('activated', self.board.type[j,i]))
-			self.board.status[j,i] = 0
-			self.board.color[j,i] = 0
-			self.board.type[j,i] = 0
-
-			mask_locked = numpy.logical_and(mask, self.board.status > 0)
-			mask_notlocked = numpy.logical_and(mask, self.board.status == 0)
-			nchanged += mask_locked.sum()
-			self.board.status[mask_locked] = self.board.status[mask_locked] - 1
-			if mask_locked.any():
-				self.board.events.append(('unlocked', mask_locked.sum()))
-			mask_notlocked_simple = numpy.logical_and(mask_notlocked, self.board.type == 1)
-			nchanged += mask_notlocked_simple.sum()
-			if mask_notlocked_simple.any():
-				self.board.events.append(('destroyed', mask_notlocked_simple.sum()))
-			self.board.type[mask_notlocked_simple] = 0
-			self.board.color[mask_notlocked_simple] = 0
-			# mark special ones for explosion
-			mask_notlocked_complex = numpy.logical_and(mask_notlocked, self.board.type > 1)
-			nchanged += mask_notlocked_complex.sum()
-			self.board.status[mask_notlocked_complex] = -1
+		while len(todo_rows) > 0:
+			idx = numpy.arange(len(todo_rows))
+			self.rng.shuffle(idx)
+			# special gems marked for explosion while working through this list
+			marked = []
+			for j, i in zip(todo_rows[idx], todo_cols[idx]):
+				# deal with that one
+				#print j,i, j.shape,i.shape
+				affects_surrounding = False
+				type = self.board.type[j,i]
+				if type == 5:
+					# choose a random color and mark those for explosion
+					colors = numpy.flatnonzero(numpy.bincount(self.board.color.ravel()))
+					if len(colors[colors > 0]) == 0:
+						color = 1
+					else:
+						color = self.rng.choice(colors[colors > 0])
+					mask = self.board.color == color
+					affects_surrounding = True
+				elif type == 4:
+					# explode 3x3
+					mask = squaremasks[j,i]
+					affects_surrounding = True
+				elif type == 3:
+					# explode vertically
+					mask = colmasks[j,i]
+				elif type == 2:
+					# explode horizontally
+					mask = rowmasks[j,i]
+				elif type == 1:
+					# simply remove. 
+					mask = singlemasks[j,i]
+					# But decrease surrounding status.
+					affects_surrounding = True
+				elif type == 0:
+					continue
+				
+				#print mask*1, 'activating, type %d' % type
+				# remove this one
+				self.board.events.append(('activated', int(self.board.type[j,i])))
+				self.board.touch((j,i))
+				self.board.touch(mask)
+				self.board.status[j,i] = 0
+				self.board.color[j,i] = 0
+				self.board.type[j,i] = 0
+				
+				mask_locked = numpy.logical_and(mask, self.board.status > 0)
+				mask_notlocked = numpy.logical_and(mask, self.board.status == 0)
+				nchanged += mask_locked.sum()
+				self.board.status[mask_locked] = self.board.status[mask_locked] - 1
+				if mask_locked.any():
+					self.board.events.append(('unlocked', mask_locked.sum()))
+				mask_notlocked_simple = numpy.logical_and(mask_notlocked, self.board.type == 1)
+				nchanged += mask_notlocked_simple.sum()
+				if mask_notlocked_simple.any():
+					self.board.events.append(('destroyed', mask_notlocked_simple.sum()))
+				self.board.type[mask_notlocked_simple] = 0
+				self.board.color[mask_notlocked_simple] = 0
+				# mark special ones for explosion
+				mask_notlocked_complex = numpy.logical_and(mask_notlocked, self.board.type > 1)
+				nchanged += mask_notlocked_complex.sum()
+				self.board.status[mask_notlocked_complex] = -1
+				if self.chain and mask_notlocked_complex.any():
+					marked.append(mask_notlocked_complex)
+				
+				if affects_surrounding:
+					# surrounding, decreasing field status
+					nchanged += unlock_neighbors(self.board, mask)
 			
-			if affects_surrounding:
-				# surrounding, decreasing field status
-				rows, cols = numpy.where(mask)
-				rows_selected = numpy.hstack([rows-1,rows,rows+1,rows])
-				cols_selected = numpy.hstack([cols,cols-1,cols,cols+1])
-				valid_top    = numpy.logical_and(rows_selected>=0, cols_selected>=0)
-				valid_bottom = numpy.logical_and(rows_selected<nrows, cols_selected<ncols)
-				valid = numpy.logical_and(valid_top, valid_bottom)
-				rows_selected, cols_selected = rows_selected[valid], cols_selected[valid]
-				for j,i in zip(rows_selected, cols_selected):
-					if mask[j,i]: continue # not the fields themselves
-					if self.board.status[j,i] > 0:
-						nchanged += 1
-						self.board.status[j,i] -= 1
+			# continue the chain reaction with the newly marked gems
+			if marked:
+				todo_rows, todo_cols = numpy.where(numpy.logical_or.reduce(marked))
+			else:
+				todo_rows, todo_cols = [], []
 		return nchanged > 0
 		
 
+def landing_rows(type, status):
+	"""
+	Row in which a gem filled in at the top of each column will end up.
+	
+	This presumes that it falls down to the first double-locked field:
+	it is the number of empty fields down to (and including) that field,
+	minus one. Works for a stack of boards as well (see gembatch).
+	"""
+	nrows = type.shape[-2]
+	doublelocked = status == 2
+	lastrow = numpy.where(doublelocked.any(axis=-2), numpy.argmax(doublelocked, axis=-2), nrows - 1)
+	above = numpy.arange(nrows).reshape((-1, 1)) <= lastrow[...,None,:]
+	return numpy.logical_and(type == 0, above).sum(axis=-2) - 1
+
+def padded_colors(board):
+	"""
+	Board colors, padded with two fields on each side, which never match.
+	Works for a stack of boards as well (see gembatch).
+	"""
+	nrows, ncols = board.shape
+	padded = numpy.full(board.color.shape[:-2] + (nrows + 4, ncols + 4), -1, dtype=int)
+	padded[...,2:-2,2:-2] = board.color
+	return padded
+
+def evaluate_swaps(board, padded, direction, j0, j1, i0, i1):
+	"""
+	Evaluate the swaps of fields j,i (with j0<=j<j1, i0<=i<i1) with
+	their right (direction=0) or lower (direction=1) neighbor.
+	
+	*padded* are the board colors from padded_colors.
+	
+	Returns three arrays covering these fields: whether the swap is a 
+	special combination, the sum of the two gem types, and the number of 
+	three-in-a-rows completed by a normal swap (or zero).
+	For a stack of boards, the arrays have a leading board dimension.
+	"""
+	nrows, ncols = board.shape
+	dj, di = (0, 1) if direction == 0 else (1, 0)
+	j1, i1 = min(j1, nrows - dj), min(i1, ncols - di)
+	h, w = max(0, j1 - j0), max(0, i1 - i0)
+	def color_at(oj, oi):
+		return padded[...,2+j0+oj:2+j0+oj+h, 2+i0+oi:2+i0+oi+w]
+	fromtype, totype = board.type[...,j0:j0+h,i0:i0+w], board.type[...,j0+dj:j0+dj+h,i0+di:i0+di+w]
+	# both have to be unlocked
+	unlocked = numpy.logical_and(board.status[...,j0:j0+h,i0:i0+w] == 0, board.status[...,j0+dj:j0+dj+h,i0+di:i0+di+w] == 0)
+	special = numpy.logical_or(numpy.logical_and(fromtype > 1, totype > 1), 
+		numpy.logical_or(numpy.logical_and(fromtype == 5, totype == 1), numpy.logical_and(fromtype == 1, totype == 5)))
+	special = numpy.logical_and(special, unlocked)
+	normal = numpy.logical_and(numpy.logical_and(fromtype > 0, totype > 0), unlocked)
+	normal = numpy.logical_and(normal, numpy.logical_not(special))
+	fromcolor, tocolor = color_at(0, 0), color_at(dj, di)
+	# can not swap gems of same color
+	normal = numpy.logical_and(normal, fromcolor != tocolor)
+	if direction == 0:
+		checks = [(fromcolor, PairCombiner.HSWAP_LEFTCOLOR), (tocolor, PairCombiner.HSWAP_RIGHTCOLOR)]
+	else:
+		checks = [(fromcolor, PairCombiner.VSWAP_TOPCOLOR), (tocolor, PairCombiner.VSWAP_BOTTOMCOLOR)]
+	score = numpy.zeros(normal.shape, dtype=int)
+	for color, offsets in checks:
+		for (aj, ai), (bj, bi) in offsets:
+			score += numpy.logical_and(color_at(aj, ai) == color, color_at(bj, bi) == color)
+	score = numpy.where(normal, score, 0)
+	typesum = fromtype.astype(int) + totype
+	return special, typesum, score
+
+def collect_moves(shape, tables):
+	"""
+	List the valid moves from the swap evaluations (see evaluate_swaps)
+	of the entire board, for horizontal and vertical swaps.
+	
+	Returns an (N, 5) int array, see PairCombiner.valid_moves.
+	"""
+	nrows, ncols = shape
+	moves = []
+	order = []
+	for direction, (special, typesum, score) in enumerate(tables):
+		dj, di = (0, 1) if direction == 0 else (1, 0)
+		rows, cols = numpy.where(special)
+		moves.append(numpy.transpose([rows, cols, rows + dj, cols + di, typesum[rows, cols]]))
+		# special combinations are listed first, in the order of the 
+		# first field, horizontal swap before vertical swap
+		order.append((rows * ncols + cols) * 2 + direction)
+		rows, cols = numpy.where(score > 0)
+		moves.append(numpy.transpose([rows, cols, rows + dj, cols + di, score[rows, cols]]))
+		# then normal horizontal swaps, then normal vertical swaps
+		order.append((1 + direction) * 2 * nrows * ncols + rows * ncols + cols)
+	
+	moves = numpy.vstack(moves).reshape((-1, 5)).astype(int)
+	order = numpy.concatenate(order)
+	moves = moves[numpy.argsort(order, kind='stable')]
+	moves = moves[numpy.argsort(-moves[:,4], kind='stable')]
+	# add the reverse swaps
+	reverse = moves[:,[2,3,0,1,4]]
+	return numpy.stack([moves, reverse], axis=1).reshape((-1, 5))
+
 class PairCombiner(object):
 	"""
 	When two gems are swapped, takes the right action if they are special
 	"""
-	def __init__(self, board):
+	def __init__(self, board, rng=None):
+		self.board = board
+		self.rng = numpy.random if rng is None else rng
+	
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
 		self.board = board
 	
 	def activate(self, rows, cols, fromj,fromi, toj,toi):
 		if self.board.type[fromj, fromi] > 1:
-			self.board.events.append(('activated', self.board.type[fromj, fromi]))
+			self.board.events.append(('activated', int(self.board.type[fromj, fromi])))
 		if self.board.type[toj, toi] > 1:
-			self.board.events.append(('activated', self.board.type[toj, toi]))
+			self.board.events.append(('activated', int(self.board.type[toj, toi])))
 		# remove the two triggers
+		self.board.touch((fromj, fromi))
+		self.board.touch((toj, toi))
 		self.board.status[fromj, fromi] = 0
 		self.board.type[fromj, fromi] = 0
 		self.board.color[fromj, fromi] = 0
@@ -471,10 +973,10 @@ class PairCombiner(object):
 		self.board.type[toj, toi] = 0
 		self.board.color[toj, toi] = 0
 		
-		nrows, ncols = self.board.shape
 		# change the status of all the selected fields
 		mask = numpy.zeros(self.board.shape, dtype=bool)
 		mask[rows,cols] = True
+		self.board.touch(mask)
 		# explode these (decrease field status, activate or set to empty)
 		mask_locked = numpy.logical_and(mask, self.board.status > 0)
 		mask_notlocked = numpy.logical_and(mask, self.board.status == 0)
@@ -489,17 +991,7 @@ class PairCombiner(object):
 		mask_notlocked_complex = numpy.logical_and(mask_notlocked, self.board.type > 1)
 		self.board.status[mask_notlocked_complex] = -1
 		# surrounding, decreasing field status
-		rows, cols = numpy.where(mask)
-		rows_selected = numpy.hstack([rows-1,rows,rows+1,rows])
-		cols_selected = numpy.hstack([cols,cols-1,cols,cols+1])
-		valid_top    = numpy.logical_and(rows_selected>=0, cols_selected>=0)
-		valid_bottom = numpy.logical_and(rows_selected<nrows, cols_selected<ncols)
-		valid = numpy.logical_and(valid_top, valid_bottom)
-		rows_selected, cols_selected = rows_selected[valid], cols_selected[valid]
-		for j,i in zip(rows_selected, cols_selected):
-			if mask[j,i]: continue
-			if self.board.status[j,i] > 0:
-				self.board.status[j,i] -= 1
+		unlock_neighbors(self.board, mask)
 	
 	def run(self, fromj,fromi, toj,toi):
 		# check if stripe+bomb, stripe+stripe, bomb+bomb, 
@@ -511,6 +1003,8 @@ class PairCombiner(object):
 		assert self.board.type[toj,toi] > 0, self.board.type[toj,toi]
 		
 		# swap
+		self.board.touch((fromj, fromi))
+		self.board.touch((toj, toi))
 		self.board.status[toj, toi], self.board.status[fromj, fromi] = self.board.status[fromj, fromi], self.board.status[toj, toi]
 		self.board.type[toj, toi], self.board.type[fromj, fromi] = self.board.type[fromj, fromi], self.board.type[toj, toi]
 		self.board.color[toj, toi], self.board.color[fromj, fromi] = self.board.color[fromj, fromi], self.board.color[toj, toi]
@@ -532,11 +1026,12 @@ class PairCombiner(object):
 			color = self.board.color[aj,ai]
 			type = self.board.type[aj,ai]
 			rows, cols = numpy.where(numpy.logical_and(numpy.logical_and(self.board.color == color, self.board.type == 1), self.board.status == 0))
+			self.board.touch((rows, cols))
 			if type == 4:
 				self.board.type[rows,cols] = type
 				self.board.events.append(('combined', 54))
 			elif type in [2,3]:
-				self.board.type[rows,cols] = 2+numpy.random.randint(1, size=rows.size)
+				self.board.type[rows,cols] = 2+random_integers(self.rng, 1, size=rows.size)
 				self.board.events.append(('combined', 52))
 			elif type == 1: # normal gem
 				# no change. just activate them.
@@ -565,130 +1060,410 @@ class PairCombiner(object):
 			self.activate(toj, Ellipsis, fromj, fromi, toj, toi)
 			self.board.events.append(('combined', 22))
 	
+	# A swap of two normal gems is valid if it completes three in a row.
+	# The lists below give the two fields (row and column offsets)
+	# which have to have the color of the gem that is moved there, 
+	# relative to the first (left/top) gem.
+	# horizontal swap, the left gem is moved right:
+	HSWAP_LEFTCOLOR = [
+		((0,2), (0,3)),   # two right of the right position
+		((1,1), (2,1)),   # two below the right position
+		((-2,1), (-1,1)), # two above the right position
+		((-1,1), (1,1)),  # one above, one below the right position
+	]
+	# horizontal swap, the right gem is moved left:
+	HSWAP_RIGHTCOLOR = [
+		((0,-2), (0,-1)), # two left of the left position
+		((1,0), (2,0)),   # two below the left position
+		((-2,0), (-1,0)), # two above the left position
+		((-1,0), (1,0)),  # one above, one below the left position
+	]
+	# vertical swap, the top gem is moved down:
+	VSWAP_TOPCOLOR = [
+		((2,0), (3,0)),   # two below the bottom position
+		((1,1), (1,2)),   # two right of the bottom position
+		((1,-2), (1,-1)), # two left of the bottom position
+		((1,-1), (1,1)),  # one left, one right of the bottom position
+	]
+	# vertical swap, the bottom gem is moved up:
+	VSWAP_BOTTOMCOLOR = [
+		((-2,0), (-1,0)), # two above the top position
+		((0,1), (0,2)),   # two right of the top position
+		((0,-2), (0,-1)), # two left of the top position
+		((0,-1), (0,1)),  # one left, one right of the top position
+	]
+	
+	def valid_moves(self):
+		"""
+		List the valid moves, computed for all swaps at once.
+		
+		A move is valid if it either
+		- leads to a combination of 3 same-color gems
+		- combines two special gems
+		- combines zapper with a normal gem
+		
+		Returns an (N, 5) int array with rows (fromj, fromi, toj, toi, score).
+		The moves are ordered by score (best first); each swap is 
+		followed by its reverse swap, which makes a difference 
+		for special gems (existing or created).
+		The score of a special combination is the sum of the gem types, 
+		the score of a normal swap is the number of completed 
+		three-in-a-rows.
+		"""
+		nrows, ncols = self.board.shape
+		padded = padded_colors(self.board)
+		tables = [evaluate_swaps(self.board, padded, direction, 0, nrows, 0, ncols) for direction in (0, 1)]
+		return collect_moves(self.board.shape, tables)
+	
 	def enumerate_valid_moves_oneway(self):
-		# list valid moves
-		# a move is valid if it either
-		# - leads to a combination of 3 same-color gems
-		# - combines two special gems
-		# - combines zapper with a normal gem
+		for fromj,fromi,toj,toi,score in self.valid_moves()[::2].tolist():
+			yield (fromj,fromi,toj,toi,score)
+	
+	def enumerate_valid_moves(self):
+		# for each swap there is the reverse swap also possible,
+		# which makes a difference in special candies (existing or created)
+		for fromj,fromi,toj,toi,score in self.valid_moves().tolist():
+			yield (fromj,fromi,toj,toi),score
+	
+	def shuffle(self, playable=False, ntries=16):
+		"""
+		Permute the colors of the unlocked simple gems.
+		
+		By default, this is a single random permutation, which may leave 
+		the board without valid moves, or with matches. With playable=True,
+		*ntries* random permutations are checked at once, and the first 
+		one without matches and with at least one valid move is taken.
+		If there is none, one is constructed (see arrange). If that 
+		fails too, the first random permutation is used, as by default:
+		the caller lets its matches settle and shuffles again if needed.
+		
+		Returns whether the board is playable (always True by default).
+		"""
 		board = self.board
-		nrows, ncols = self.board.shape
-		moves = []
-		Hmoves = []
-		Vmoves = []
+		mask = numpy.logical_and(board.status == 0, board.type == 1)
+		irows, icols = numpy.where(mask)
+		if not playable:
+			idx = numpy.arange(len(irows))
+			self.rng.shuffle(idx)
+			orows, ocols = irows[idx], icols[idx]
+			board.touch((orows, ocols))
+			board.color[orows,ocols] = board.color[irows,icols]
+			return True
 		
-		for fromj in range(nrows):
-			for fromi in range(ncols):
-				if self.board.status[fromj,fromi] != 0:
-					continue
-				# swap right
-				fromtype = self.board.type[fromj,fromi]
-				toj, toi = fromj, fromi+1
-				# make sure that both are unlocked
-				if toi < ncols and self.board.status[toj,toi] == 0:
-					totype = self.board.type[toj,toi]
-					if fromtype > 1 and totype > 1 or (fromtype,totype) in [(5,1),(1,5)]:
-						yield (fromj,fromi,toj,toi,fromtype+totype)
-					elif fromtype > 0 and totype > 0:
-						Hmoves.append((fromj,fromi,toj,toi))
-				
-				# swap down
-				toj, toi = fromj+1, fromi
-				if toj < nrows and self.board.status[toj,toi] == 0:
-					totype = self.board.type[toj,toi]
-					if fromtype > 1 and totype > 1 or (fromtype,totype) in [(5,1),(1,5)]:
-						yield (fromj,fromi,toj,toi,fromtype+totype)
-					elif fromtype > 0 and totype > 0:
-						Vmoves.append((fromj,fromi,toj,toi))
+		palette = board.color[irows,icols].astype(int)
+		order = numpy.argsort(self.rng.uniform(size=(ntries, len(palette))), axis=1)
+		colors = numpy.repeat(board.color[None].astype(int), ntries, axis=0)
+		colors[:,irows,icols] = palette[order]
+		ok = self.playable_colors(colors)
+		if not ok.any():
+			arranged = self.arrange(irows, icols, palette, ntries)
+			if arranged is not None:
+				colors[0] = arranged
+				ok[0] = True
+		# (if that failed too, this is the first, plain permutation)
+		k = numpy.argmax(ok)
+		board.touch((irows, icols))
+		board.color[irows,icols] = colors[k,irows,icols]
+		return bool(ok[k])
+	
+	def playable_colors(self, colors):
+		"""
+		Check a stack of board colorings (the board with other colors):
+		true where there is no match of three and at least one valid move.
+		"""
+		board = self.board
+		nrows, ncols = board.shape
+		matchable = numpy.logical_and(board.type > 0, board.status == 0)
+		hruns, vruns = find_runs(colors, matchable, 3)
+		matched = numpy.logical_or(hruns[3].any(axis=(-2,-1)), vruns[3].any(axis=(-2,-1)))
+		padded = numpy.full(colors.shape[:-2] + (nrows + 4, ncols + 4), -1, dtype=int)
+		padded[...,2:-2,2:-2] = colors
+		movable = numpy.zeros(colors.shape[:-2], dtype=bool)
+		for direction in 0, 1:
+			special, _, score = evaluate_swaps(board, padded, direction, 0, nrows, 0, ncols)
+			movable |= numpy.logical_or(special, score > 0).any(axis=(-2,-1))
+		return numpy.logical_and(movable, numpy.logical_not(matched))
+	
+	def move_templates(self, shuffled):
+		"""
+		Normal swaps which the shuffle can make valid: lists of
+		(moved gem, the two fields completing the three, other gem),
+		where the first three are shuffled fields.
+		"""
+		board = self.board
+		nrows, ncols = board.shape
+		swappable = numpy.logical_and(board.status == 0, numpy.logical_and(board.type >= 1, board.type <= 4))
+		def inside(j, i):
+			return 0 <= j < nrows and 0 <= i < ncols
+		templates = []
+		for j, i in zip(*numpy.where(shuffled)):
+			for dj, di, first, second in (0, 1, self.HSWAP_LEFTCOLOR, self.HSWAP_RIGHTCOLOR), (1, 0, self.VSWAP_TOPCOLOR, self.VSWAP_BOTTOMCOLOR):
+				# j,i is the first (left/top) or the second gem of the swap
+				for (aj, ai), (oj, oi), offsets in ((j, i), (j + dj, i + di), first), ((j - dj, i - di), (j - dj, i - di), second):
+					if not inside(oj, oi) or not inside(aj, ai) or not swappable[oj,oi]:
+						continue
+					for (pj, pi), (qj, qi) in offsets:
+						p, q = (aj + pj, ai + pi), (aj + qj, ai + qi)
+						if inside(*p) and inside(*q) and shuffled[p] and shuffled[q]:
+							templates.append(((j, i), p, q, (oj, oi)))
+		return templates
+	
+	def arrange(self, irows, icols, palette, ntries):
+		"""
+		Construct colors of the shuffled fields (at irows, icols),
+		a permutation of *palette*, which make the board playable. 
 		
-		# we are not checking whether gems participating in a match are locked
-		for j,lefti,_,righti in Hmoves:
-			assert (j,lefti) != (j,righti)
-			# horizontal swap can lead to horizontal 3s
-			leftcolor = self.board.color[j,lefti]
-			rightcolor = self.board.color[j,righti]
-			if leftcolor == rightcolor: 
-				# can not swap gems of same color
-				continue
-			# check if next to to(right) are 2 of from-color
-			if righti+2 < ncols and (board.color[j,righti+1:righti+2+1] == leftcolor).all():
-				yield (j,lefti,j,righti,1)
-			if lefti >= 2 and (board.color[j,lefti-2:lefti] == rightcolor).all():
-				yield (j,lefti,j,righti,1)
-			# no horizontal match. Lets find a vertical match
-			# vertical matches can happen if it completes a row
-			# two above are completed at the right position
-			if j+2 < nrows and (board.color[j+1:j+2+1,righti] == leftcolor).all():
-				yield (j,lefti,j,righti,1)
-			# two below are completed at the right position
-			if j >= 2 and (board.color[j-2:j,righti] == leftcolor).all():
-				yield (j,lefti,j,righti,1)
-			# one above, one below are completed at the right position
-			if j >= 1 and j+1 < nrows and board.color[j-1,righti] == leftcolor == board.color[j+1,righti]:
-				yield (j,lefti,j,righti,1)
-			# two below are completed at the left position
-			if j+2 < nrows and (board.color[j+1:j+2+1,lefti] == rightcolor).all():
-				yield (j,lefti,j,righti,1)
-			# two above are completed at the left position
-			if j >= 2 and (board.color[j-2:j,lefti] == rightcolor).all():
-				yield (j,lefti,j,righti,1)
-			# one above, one below are completed at the left position
-			if j >= 1 and j+1 < nrows and board.color[j-1,lefti] == rightcolor == board.color[j+1,lefti]:
-				yield (j,lefti,j,righti,1)
+		A valid swap is set up first (see move_templates), then the 
+		other fields are filled one by one, avoiding matches of three.
+		Up to *ntries* swaps are tried; returns the board colors,
+		or None if all of them failed.
+		"""
+		board = self.board
+		nrows, ncols = board.shape
+		matchable = numpy.logical_and(board.type > 0, board.status == 0)
+		shuffled = numpy.zeros(board.shape, dtype=bool)
+		shuffled[irows,icols] = True
+		templates = self.move_templates(shuffled)
+		ncolors = palette.max() + 1 if len(palette) else 0
+		
+		def completes_three(grid, j, i, color):
+			for dj, di in (0, 1), (1, 0):
+				n = 1
+				for sign in -1, 1:
+					k = 1
+					while 0 <= j + sign*k*dj < nrows and 0 <= i + sign*k*di < ncols and \
+							matchable[j + sign*k*dj, i + sign*k*di] and grid[j + sign*k*dj, i + sign*k*di] == color:
+						k += 1
+					n += k - 1
+				if n >= 3:
+					return True
+			return False
 		
-		for topj,i,bottomj,_ in Vmoves:
-			assert (topj,i) != (bottomj,i)
-			topcolor = self.board.color[topj,i]
-			bottomcolor = self.board.color[bottomj,i]
-			if topcolor == bottomcolor: 
-				# can not swap gems of same color
+		for t in numpy.argsort(self.rng.uniform(size=len(templates)))[:ntries]:
+			moved, p, q, other = templates[t]
+			counts = numpy.bincount(palette, minlength=ncolors)
+			candidates = numpy.where(counts >= 3)[0]
+			if len(candidates) == 0:
+				return None
+			color = candidates[random_integers(self.rng, len(candidates))]
+			# unset fields never match
+			grid = numpy.where(shuffled, -1, board.color).astype(int)
+			if not shuffled[other] and grid[other] == color:
 				continue
-			# vertical swap can lead to vertical 3s
-			# check if above/below to(bottom) are 2 of from-color
-			if bottomj+2 < nrows and (board.color[bottomj+1:bottomj+2+1,i] == topcolor).all():
-				yield (topj,i,bottomj,i,1)
-			if topj >= 2 and (board.color[topj-2:topj,i] == bottomcolor).all():
-				yield (topj,i,bottomj,i,1)
-			# no vertical match. Lets find a horizontal match
-			# horizontal matches can happen if it completes a column
-			# two right are completed at the bottom position
-			if i+2 < ncols and (board.color[bottomj,i+1:i+2+1] == topcolor).all():
-				yield (topj,i,bottomj,i,1)
-			# two left are completed at the bottom position
-			if i >= 2 and (board.color[bottomj,i-2:i] == topcolor).all():
-				yield (topj,i,bottomj,i,1)
-			# one left, one right are completed
-			if i >= 1 and i+1 < ncols and board.color[bottomj,i-1] == topcolor == board.color[bottomj,i+1]:
-				yield (topj,i,bottomj,i,1)
-			# two right are completed at the top position
-			if i+2 < ncols and (board.color[topj,i+1:i+2+1] == bottomcolor).all():
-				yield (topj,i,bottomj,i,1)
-			# two left are completed at the top position
-			if i >= 2 and (board.color[topj,i-2:i] == bottomcolor).all():
-				yield (topj,i,bottomj,i,1)
-			# one right, one left are completed at the top position
-			if i >= 1 and i+1 < ncols and board.color[topj,i-1] == bottomcolor == board.color[topj,i+1]:
-				yield (topj,i,bottomj,i,1)
+			success = True
+			for field in moved, p, q:
+				if completes_three(grid, field[0], field[1], color):
+					success = False
+				grid[field] = color
+			counts[color] -= 3
+			if not success:
+				continue
+			for j, i in zip(irows, icols):
+				if grid[j,i] >= 0:
+					continue
+				options = [c for c in range(ncolors) if counts[c] > 0 and 
+					not (c == color and (j, i) == other) and not completes_three(grid, j, i, c)]
+				if not options:
+					success = False
+					break
+				# draw a color with probability proportional to how many 
+				# gems of it are left to place
+				weights = counts[options].cumsum()
+				c = options[numpy.searchsorted(weights, self.rng.uniform() * weights[-1], side='right')]
+				grid[j,i] = c
+				counts[c] -= 1
+			if success and self.playable_colors(grid)[()]:
+				return grid
+		return None
 		
+
+class MoveIndex(object):
+	"""
+	Keeps the list of valid moves of a board up to date.
+	
+	The swap evaluations are stored, and only the swaps near fields 
+	which were touched since the last query are re-evaluated.
+	"""
+	# a swap of j,i depends on fields up to two rows/columns before 
+	# and three after it.
+	MARGIN_BEFORE = 3
+	MARGIN_AFTER = 2
+	
+	def __init__(self, board):
+		self.board = None
+		self.bind(board)
+	
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
+		self.close()
+		self.board = board
+		self.dirty = board.track_changes()
+		nrows, ncols = board.shape
+		self.tables = []
+		for h, w in (nrows, max(0, ncols - 1)), (max(0, nrows - 1), ncols):
+			self.tables.append((numpy.zeros((h, w), dtype=bool), 
+				numpy.zeros((h, w), dtype=int), numpy.zeros((h, w), dtype=int)))
+	
+	def close(self):
+		"""
+		Stop following the changes of the board.
+		"""
+		if self.board is not None:
+			self.board.untrack(self.dirty)
+			self.board = None
+	
+	def update(self):
+		"""
+		Re-evaluate the swaps near changed fields.
+		"""
+		if not self.dirty.any():
+			return
+		rows, cols = numpy.where(self.dirty)
+		self.dirty[...] = False
+		j0 = max(0, rows.min() - self.MARGIN_BEFORE)
+		j1 = rows.max() + self.MARGIN_AFTER + 1
+		i0 = max(0, cols.min() - self.MARGIN_BEFORE)
+		i1 = cols.max() + self.MARGIN_AFTER + 1
+		padded = padded_colors(self.board)
+		for direction, table in enumerate(self.tables):
+			for old, new in zip(table, evaluate_swaps(self.board, padded, direction, j0, j1, i0, i1)):
+				old[j0:j0+new.shape[0],i0:i0+new.shape[1]] = new
+	
+	def valid_moves(self):
+		"""
+		Same as PairCombiner.valid_moves.
+		"""
+		self.update()
+		return collect_moves(self.board.shape, self.tables)
+	
 	def enumerate_valid_moves(self):
-		# for each swap there is the reverse swap also possible,
-		# which makes a difference in special candies (existing or created)
-		scores = Counter()
-		for fromj,fromi,toj,toi,score in self.enumerate_valid_moves_oneway():
-			assert (fromj,fromi) != (toj,toi)
-			scores[(fromj,fromi,toj,toi)] += score
-		for (fromj,fromi,toj,toi),score in scores.most_common():
+		for fromj,fromi,toj,toi,score in self.valid_moves().tolist():
 			yield (fromj,fromi,toj,toi),score
-			yield (toj,toi,fromj,fromi),score
+
+def pattern_runs(mask):
+	"""
+	Decompose a pattern mask into horizontal and vertical runs.
 	
-	def shuffle(self):
-		mask = numpy.logical_and(self.board.status == 0, self.board.type == 1)
-		irows, icols = numpy.where(mask)
-		idx = numpy.arange(len(irows))
-		numpy.random.shuffle(idx)
-		orows, ocols = irows[idx], icols[idx]
-		self.board.color[orows,ocols] = self.board.color[irows,icols]
-		
+	Returns a list of (direction, length, row offset, column offset)
+	for every maximal horizontal ('H') and vertical ('V') run 
+	of at least two cells in the mask.
+	"""
+	runs = []
+	nrows, ncols = mask.shape
+	for direction, m in ('H', mask), ('V', mask.T):
+		for j, row in enumerate(m):
+			i = 0
+			while i < len(row):
+				if not row[i]:
+					i += 1
+					continue
+				k = 1
+				while i + k < len(row) and row[i + k]:
+					k += 1
+				if k > 1:
+					runs.append((direction, k, j, i) if direction == 'H' else (direction, k, i, j))
+				i += k
+	covered = numpy.zeros(mask.shape, dtype=bool)
+	for direction, k, j, i in runs:
+		if direction == 'H':
+			covered[j,i:i+k] = True
+		else:
+			covered[j:j+k,i] = True
+	assert (covered == mask).all(), ('pattern can not be decomposed into runs', mask*1)
+	return runs
+
+def find_runs(color, matchable, maxlength):
+	"""
+	Find runs of matchable gems of the same color.
+	
+	Returns two dictionaries, for horizontal and vertical runs,
+	from run length k (up to maxlength) to a boolean array. It is true 
+	where a run of (at least) k gems starts, towards the right/bottom.
+	The arrays have the shape of a 'valid' correlation of the board
+	with a 1xk (kx1) pattern. The inputs may have leading dimensions, 
+	for a stack of boards.
+	"""
+	same_h = matchable[...,:,:-1] & matchable[...,:,1:] & (color[...,:,:-1] == color[...,:,1:])
+	same_v = matchable[...,:-1,:] & matchable[...,1:,:] & (color[...,:-1,:] == color[...,1:,:])
+	hruns = {1: matchable}
+	vruns = {1: matchable}
+	for k in range(2, maxlength + 1):
+		hruns[k] = hruns[k-1][...,:,:-1] & same_h[...,:,k-2:]
+		vruns[k] = vruns[k-1][...,:-1,:] & same_v[...,k-2:,:]
+	return hruns, vruns
+
+def resolve_conflicts(matchcells, ncells):
+	"""
+	Select which of the candidate matches to act on.
+	
+	matchcells is a list of arrays of (flat) cell indices, one per match.
+	If two matches share a cell, the longer one wins. Matches which only
+	conflict with matches of the same length are accepted greedily,
+	in order, unless they overlap with an already accepted match.
+	
+	Returns the indices of the accepted matches.
+	"""
+	if len(matchcells) == 0:
+		return []
+	sizes = numpy.array([len(cells) for cells in matchcells])
+	cell_ids = numpy.concatenate(matchcells)
+	match_ids = numpy.repeat(numpy.arange(len(matchcells)), sizes)
+	cell_sizes = sizes[match_ids]
+	# occupancy index: longest match on each cell, and how many of that length
+	longest = numpy.zeros(ncells, dtype=int)
+	numpy.maximum.at(longest, cell_ids, cell_sizes)
+	nlongest = numpy.bincount(cell_ids[cell_sizes == longest[cell_ids]], minlength=ncells)
+	# a longer match overlaps
+	beaten = numpy.bincount(match_ids, weights=longest[cell_ids] > cell_sizes, minlength=len(sizes)) > 0
+	# another match of the same length overlaps
+	tied = numpy.bincount(match_ids, weights=nlongest[cell_ids] > 1, minlength=len(sizes)) > 0
+	accepted = list(numpy.where(~beaten & ~tied)[0])
+	# matches with equally good options are accepted greedily
+	occupied = numpy.zeros(ncells, dtype=bool)
+	for k in accepted:
+		occupied[matchcells[k]] = True
+	for k in numpy.where(~beaten & tied)[0]:
+		if not occupied[matchcells[k]].any():
+			occupied[matchcells[k]] = True
+			accepted.append(k)
+	return accepted
+
+@functools.lru_cache(maxsize=16)
+def compile_patterns(shape):
+	"""
+	Parse Combiner.SHAPES for boards of the given shape.
+	
+	The result is shared by all Combiners working on boards of the 
+	same shape, and is cached for the most recently used shapes.
+	
+	Returns the patterns, as a tuple of 
+	(name, mask, number of cells, runs, flat cell index offsets), 
+	and the longest run in any of them.
+	"""
+	patterns = []
+	maxrun = 1
+	for shapestr in Combiner.SHAPES:
+		shapeparts = shapestr.split('\n')[:-1]
+		name = shapeparts[0]
+		shapeparts = shapeparts[1:]
+		nrows = len(shapeparts)
+		ncols = len(shapeparts[0])
+		# if pattern is bigger than board, it can never match
+		if nrows > shape[0]: continue
+		if ncols > shape[1]: continue
+		maskarr = numpy.array([[c=='1' for c in shaperow] for shaperow in shapeparts])
+		assert maskarr.shape == (nrows, ncols)
+		runs = pattern_runs(maskarr)
+		maxrun = max([maxrun] + [k for _, k, _, _ in runs])
+		# flat board index offsets of the pattern cells
+		cellrows, cellcols = numpy.where(maskarr)
+		offsets = cellrows * shape[1] + cellcols
+		maskarr.flags.writeable = False
+		offsets.flags.writeable = False
+		patterns.append((name, maskarr, maskarr.sum(), runs, offsets))
+	return tuple(patterns), maxrun
 
 class Combiner(object):
 	SHAPES = [
@@ -763,30 +1538,19 @@ class Combiner(object):
 	"""
 	Collapses any gem sequences on the current board
 	"""
-	def __init__(self, board):
-		self.board = board
-		self.patterns = []
-		for shapestr in Combiner.SHAPES:
-			shapeparts = shapestr.split('\n')[:-1]
-			name = shapeparts[0]
-			shapeparts = shapeparts[1:]
-			nrows = len(shapeparts)
-			ncols = len(shapeparts[0])
-			# if pattern is bigger than board, it can never match
-			if nrows > self.board.shape[0]: continue
-			if ncols > self.board.shape[1]: continue
-			maskarr = numpy.array([[c=='1' for c in shaperow] for shaperow in shapeparts])
-			self.log((maskarr*1, name))
-			assert maskarr.shape == (nrows, ncols)
-			needs_H3 = name in ['H4','H5']
-			needs_V3 = name in ['V4','V5']
-			if name[0] in ['T','L']:
-				needs_H3 = True
-				needs_V3 = True
-			self.patterns.append((name, maskarr, maskarr.sum(), needs_H3, needs_V3))
+	def __init__(self, board, rng=None):
+		self.rng = numpy.random if rng is None else rng
+		self.bind(board)
 		self.fromj, self.fromi = None, None
 		self.toj, self.toi = None, None
 	
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
+		self.board = board
+		self.patterns, self.maxrun = compile_patterns(board.shape)
+	
 	def log(self, *args):
 		#print(args)
 		pass
@@ -806,104 +1570,48 @@ class Combiner(object):
 		matchable = numpy.logical_and(self.board.type > 0, self.board.status == 0)
 		# and color has to be the same
 		
-		
-		# the trick here is basically a bitmask. 
-		# colors 1,2,3 are substituted for 10 100 1000
-		# If the result is Nmask * 100, then we have Nmask of color=2. 
-		# That value can not be reached by fewer color=3 stones or more color=1 stones.
-		boardcolors = 10**self.board.color * matchable
-		maxcolor = self.board.color.max()
-		has_H3 = False
-		has_V3 = False
-		for name, mask, Nmask, needs_H3, needs_V3 in self.patterns:
-			if needs_H3 and not has_H3 or needs_V3 and not has_V3:
-				continue
-			#print 'MATCHING:', name
-			values = scipy.signal.correlate2d(boardcolors, mask, mode='valid')
-			colors = numpy.log10(numpy.where(values<=0, 1, values * 1. / Nmask)).astype(int)
-			has_valid_results = 10**colors * Nmask == values
+		# every pattern is made of horizontal and vertical runs of 
+		# same-colored gems (see pattern_runs), so find those runs first
+		hruns, vruns = find_runs(self.board.color, matchable, self.maxrun)
+		for name, mask, Nmask, runs, offsets in self.patterns:
+			mrows, mcols = mask.shape
+			# pattern placements, as for a 'valid' correlation with the board
+			has_valid_results = numpy.ones((nrows - mrows + 1, ncols - mcols + 1), dtype=bool)
+			for direction, k, dj, di in runs:
+				found = hruns[k] if direction == 'H' else vruns[k]
+				has_valid_results &= found[dj:dj + nrows - mrows + 1, di:di + ncols - mcols + 1]
 			
-			#print self.board.color
-			#print values, valid_results*1
 			#print 'where are valid results?:', has_valid_results*1
 			if not has_valid_results.any(): 
 				continue
-			if name == 'H3':
-				has_H3 = True
-			elif name == 'V3':
-				has_V3 = True
-			mrows, mcols = mask.shape
-			#print numpy.where(has_valid_results, numpy.log10(values/Nmask).astype(int), 0), 'for', name
+			# the color of the first run is the color of the pattern
+			_, _, cj, ci = runs[0]
 			rows, cols = numpy.where(has_valid_results)
-			for j, i, color in zip(rows, cols, colors[has_valid_results]):
-				#oboardmask = numpy.pad(mask, ((j,nrows-mrows-j), (i,ncols-mcols-i)), 'constant', constant_values=False)
-				boardmask = numpy.zeros((nrows,ncols))
-				boardmask[j:j+mrows,i:i+mcols] = mask
-				#assert (oboardmask == boardmask).all()
-				matches.append((j, i, name, color, boardmask))
+			# cells covered by each placement, as flat board indices
+			cells = (rows * ncols + cols).reshape((-1, 1)) + offsets.reshape((1, -1))
+			for j, i, matchcells in zip(rows, cols, cells):
+				color = int(self.board.color[j + cj, i + ci])
+				matches.append((j, i, name, color, matchcells))
 		
-		#print [(name, j, i) for (j, i, name, color, boardmask) in omatches]
-		#print [(name, j, i) for (j, i, name, color, boardmask) in matches]
 		# check for conflicts
-		matches_accepted = []
-		matches_remaining = []
 		self.log(('have %d potential matches' % len(matches)))
 		# if two matches affect the same idx, always choose the longer one
-		#print 'finding non-conflicting matches...'
-		for k, match in enumerate(matches):
-			j, i, name, matched_color, mask = match
-			conflict_status = 0
-			for match2 in matches[:k] + matches[k+1:]:
-				j2, i2, name2, matched_color2, mask2 = match2
-				if numpy.logical_and(mask, mask2).any():
-					# conflict
-					if mask2.sum() > mask.sum():
-						# there is a larger one, so match should be removed
-						conflict_status = 2
-						#print 'discarding', mask*1, 'because of', mask2*1
-					elif mask2.sum() == mask.sum() and conflict_status == 0:
-						# there is one of the same length
-						conflict_status = 1
-						#print 'stalling', mask*1, 'because of', mask2*1
-				
-			if conflict_status == 0:
-				matches_accepted.append(match)
-				#print 'accepting match', mask*1
-			elif conflict_status == 1:
-				matches_remaining.append(match)
-		
-		#print 'extending matches (have %d)...' % (len(matches_accepted))
-		# at this point, we have secure matches in matches_accepted
-		# matches_remaining may have several equally good options.
-		# accept them greedily
-		for match in matches_remaining:
-			j, i, name, matched_color, mask = match
-			conflict_free = True
-			for match2 in matches_accepted:
-				j2, i2, name2, matched_color2, mask2 = match2
-				if numpy.logical_and(mask, mask2).any():
-					# conflict with already accepted one
-					conflict_free = False
-					#print 'discarding', mask*1, 'because of', mask2*1
-					break
-			
-			if conflict_free:
-				matches_accepted.append(match)
-				#print 'accepting match', mask*1
-			else:
-				#print 'not accepting match', mask*1
-				pass
+		accepted = resolve_conflicts([match[-1] for match in matches], nrows * ncols)
+		matches_accepted = [matches[k] for k in accepted]
 		
 		self.log(('acting on matches:'))
 		# we have now a set of matches (ideally just one)
 		changed = len(matches_accepted) > 0
 		for match in matches_accepted:
-			j, i, name, matched_color, mask = match
+			j, i, name, matched_color, matchcells = match
+			mask = numpy.zeros(nrows * ncols, dtype=bool)
+			mask[matchcells] = True
+			mask = mask.reshape((nrows, ncols))
 			#print 'match:', j,i,name,matched_color, 'mask:'
 			#print mask*1
 			
 			# explode these (decrease field status, activate or set to empty)
-			
+			self.board.touch(mask)
 			mask_locked = numpy.logical_and(mask, self.board.status > 0)
 			mask_notlocked = numpy.logical_and(mask, self.board.status == 0)
 			self.board.status[mask_locked] = self.board.status[mask_locked] - 1
@@ -924,33 +1632,24 @@ class Combiner(object):
 			#print 'after removing those ...'
 			#print self.board
 			#print 'marking nearby ...'
+			unlock_neighbors(self.board, mask)
 			rows, cols = numpy.where(mask)
-			rows_selected = numpy.hstack([rows-1,rows,rows+1,rows])
-			cols_selected = numpy.hstack([cols,cols-1,cols,cols+1])
-			valid_top    = numpy.logical_and(rows_selected>=0, cols_selected>=0)
-			valid_bottom = numpy.logical_and(rows_selected<nrows, cols_selected<nrows)
-			valid = numpy.logical_and(valid_top, valid_bottom)
-			rows_selected, cols_selected = rows_selected[valid], cols_selected[valid]
-			#print rows_selected, cols_selected
-			for j,i in zip(rows_selected, cols_selected):
-				if mask[j,i]: continue
-				if self.board.status[j,i] > 0:
-					self.board.status[j,i] -= 1
 			
 			# if T.*|X4|X5 replace one location in the pattern with the special item of the right color
 			if name[1] == '4' or name[1] == '5' or name.startswith('T') or name.startswith('L'):
 				# the preferred location is to, from or random otherwise
-				k = numpy.random.randint(len(rows))
+				k = random_integers(self.rng, len(rows))
 				j, i = rows[k], cols[k]
 				# draw again to avoid replacing something
 				if self.board.type[j,i] > 1:
-					k = numpy.random.randint(len(rows))
+					k = random_integers(self.rng, len(rows))
 					j, i = rows[k], cols[k]
 				
 				if self.toi is not None and mask[self.toj,self.toi]:
 					j, i = self.toj,self.toi
 				elif self.fromi is not None and mask[self.fromj,self.fromi]:
 					j, i = self.fromj,self.fromi
+				self.board.touch((j,i))
 				if name == 'H4':
 					self.board.color[j,i] = matched_color
 					self.board.type[j,i] = 2
@@ -973,74 +1672,261 @@ class Combiner(object):
 		
 		return changed
 
+# number of cell_codes (type -1..5, status -1..2); the color (any int8)
+# is coded separately, see color_codes
+ncellcodes = 7 * 4
+
+@functools.lru_cache(maxsize=16)
+def zobrist_keys(shape):
+	"""
+	Random 64 bit keys for Zobrist hashing of boards of the given shape.
+	
+	Returns an array of shape (nrows, ncols, 28 + 256), indexed with
+	[j,i,cell_codes(...)] and [j,i,28 + color_codes(...)]. 
+	The keys are the same in every run.
+	"""
+	rng = numpy.random.RandomState(12345 + 1000 * shape[0] + shape[1])
+	keys = rng.randint(0, 2**64, size=shape + (ncellcodes + 256,), dtype=numpy.uint64)
+	keys.flags.writeable = False
+	return keys
+
+def cell_codes(cells):
+	"""
+	Number 0..27 for each combination of type and status.
+	"""
+	return (cells['type'].astype(numpy.intp) + 1) * 4 + cells['status'] + 1
+
+def color_codes(cells):
+	"""
+	Number 0..255 for each color.
+	"""
+	return cells['color'].astype(numpy.uint8).astype(numpy.intp)
+
+def field_keys(keys, cells):
+	"""
+	Zobrist keys of the cells, from the keys of their fields
+	(the last axis of zobrist_keys).
+	"""
+	codes = cell_codes(cells)[...,None]
+	colors = ncellcodes + color_codes(cells)[...,None]
+	return numpy.take_along_axis(keys, codes, axis=-1)[...,0] ^ numpy.take_along_axis(keys, colors, axis=-1)[...,0]
+
+def zobrist_hash(board):
+	"""
+	Zobrist hash of the board (from scratch), as an int.
+	"""
+	keys = field_keys(zobrist_keys(board.shape), board.cells)
+	return int(numpy.bitwise_xor.reduce(keys, axis=None))
+
+class ZobristHash(object):
+	"""
+	Keeps the Zobrist hash of a board up to date.
+	
+	The hash is the XOR of one key per field, chosen by the field's
+	type, color and status. When queried, only the keys of fields 
+	touched since the last query are replaced.
+	"""
+	def __init__(self, board):
+		self.board = None
+		self.bind(board)
+	
+	def bind(self, board):
+		"""
+		Operate on *board* from now on.
+		"""
+		self.close()
+		self.board = board
+		self.dirty = board.track_changes()
+		self.keys = zobrist_keys(board.shape).reshape((-1, ncellcodes + 256))
+		self.fieldkeys = numpy.zeros(board.shape[0] * board.shape[1], dtype=numpy.uint64)
+		self.value = 0
+	
+	def close(self):
+		"""
+		Stop following the changes of the board.
+		"""
+		if self.board is not None:
+			self.board.untrack(self.dirty)
+			self.board = None
+	
+	def update(self):
+		"""
+		Replace the keys of changed fields.
+		"""
+		if not self.dirty.any():
+			return
+		idx = numpy.flatnonzero(self.dirty)
+		self.dirty[...] = False
+		old = self.fieldkeys[idx]
+		new = field_keys(self.keys[idx], self.board.cells.reshape(-1)[idx])
+		self.fieldkeys[idx] = new
+		self.value ^= int(numpy.bitwise_xor.reduce(old ^ new))
+	
+	def hash(self):
+		"""
+		Zobrist hash of the board, as an int.
+		"""
+		self.update()
+		return self.value
+
+class TranspositionTable(object):
+	"""
+	Results for board positions (e.g. by Zobrist hash), 
+	keeping the *maxsize* most recently used ones.
+	"""
+	def __init__(self, maxsize=100000):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+	
+	def get(self, key, default=None):
+		try:
+			value = self.entries[key]
+		except KeyError:
+			self.misses += 1
+			return default
+		self.hits += 1
+		self.entries.move_to_end(key)
+		return value
+	
+	def put(self, key, value):
+		self.entries[key] = value
+		self.entries.move_to_end(key)
+		if len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+	
+	def __contains__(self, key):
+		return key in self.entries
+	
+	def __len__(self):
+		return len(self.entries)
+	
+	def clear(self):
+		self.entries.clear()
+	
+	def save(self, filename, version=None):
+		"""
+		Write the entries to a JSON file (least recently used first),
+		along with a *version* to check when loading. Keys and values
+		must be numbers, None or (nested) tuples of these.
+		"""
+		with open(filename, 'w') as f:
+			json.dump(dict(version=version, entries=list(self.entries.items())), f, default=json_number)
+	
+	def load(self, filename, version=None):
+		"""
+		Add the entries of a file written by save() with the same 
+		*version*. If the version differs, nothing is added and False
+		is returned. The file is plain data, nothing in it is executed.
+		"""
+		with open(filename) as f:
+			data = json.load(f)
+		if as_tuples(data.get('version')) != version:
+			return False
+		for key, value in data['entries']:
+			self.put(as_tuples(key), as_tuples(value))
+		return True
+
+def json_number(value):
+	"""
+	numpy scalars as python numbers, for json.dump.
+	"""
+	if isinstance(value, numpy.integer):
+		return int(value)
+	if isinstance(value, numpy.floating):
+		return float(value)
+	raise TypeError('%r can not be written as JSON' % (value,))
+
+def as_tuples(value):
+	"""
+	JSON lists (nested) as tuples.
+	"""
+	if isinstance(value, list):
+		return tuple(as_tuples(v) for v in value)
+	return value
+
+class CascadeLimitException(Exception):
+	"""
+	The board did not settle down within the allowed number of cascades.
+	"""
+	pass
+
+def settle(board, grav, topfill, comb, acto, maxcascades=1000, callback=None, counts=None):
+	"""
+	Let the board settle down.
+	
+	Gems drop (grav) and come in from the top (topfill, can be None)
+	until nothing moves any more. If topfill fills whole columns, the 
+	gems are dropped with grav.settle() instead of step by step with 
+	grav.run(). Then matches are combined (comb)
+	and special gems activated (acto). This repeats until a round
+	of combining and activating changes nothing.
+	
+	callback(phase, result), if given, is called after every phase
+	('grav', 'topfill', 'comb' or 'acto') with the result of its run().
+	counts, if given (e.g. a Counter), counts the phases which changed
+	something. Raises CascadeLimitException if the board has not settled
+	after *maxcascades* rounds of combining and activating.
+	
+	Returns the number of rounds in which something was combined or
+	activated.
+	"""
+	ncascades = 0
+	whole_columns = getattr(topfill, 'whole_columns', False)
+	while True:
+		# dropping phase
+		anychange = True
+		while anychange:
+			anychange = grav.settle() if whole_columns else grav.run()
+			if callback is not None:
+				callback('grav', anychange)
+			if counts is not None and anychange:
+				counts['grav'] += 1
+			if topfill is not None:
+				filled = topfill.run()
+				if callback is not None:
+					callback('topfill', filled)
+				if counts is not None and filled:
+					counts['topfill'] += 1
+				anychange = anychange or filled
+		
+		# combining phase
+		combined = comb.run()
+		if callback is not None:
+			callback('comb', combined)
+		activated = acto.run()
+		if callback is not None:
+			callback('acto', activated)
+		if counts is not None:
+			counts['comb'] += bool(combined)
+			counts['acto'] += bool(activated)
+		if not (combined or activated):
+			return ncascades
+		ncascades += 1
+		if ncascades >= maxcascades:
+			raise CascadeLimitException('board did not settle after %d cascades' % ncascades)
+
 def best_move_selector(board, moves):
 	return moves[0][0]
 
 def worst_move_selector(board, moves):
 	return moves[-1][0]
 
-def random_move_selector(board, moves):
-	i = numpy.random.randint(len(moves))
+def random_move_selector(board, moves, rng=None):
+	i = random_integers(numpy.random if rng is None else rng, len(moves))
 	return moves[i][0]
 
-def smart_move_selector(board, moves):
-	# store seed and board
-	orig_state = numpy.random.get_state()
-	orig_board = board.copy()
-	totalscores = []
-	for move, score in moves:
-		# emulate move
-		# make a copy of the board here.
-		board.type = orig_board.type.copy()
-		board.status = orig_board.status.copy()
-		board.color = orig_board.color.copy()
-		board.events = list(orig_board.events)
-		
-		# also, set a new seed, and restore later
-		numpy.random.seed(1)
-
-		grav = BoardGravityPuller(board)
-		comb = Combiner(board)
-		paircomb = PairCombiner(board)
-		acto = Activater(board)
-		
-		paircomb.run(*move)
-		comb.set_last_interaction(*move)
-		anychange  = comb.run()
-		anychange += acto.run()
-		while anychange:
-			if grav.run(): continue
-			anychange  = comb.run()
-			anychange += acto.run()
-		
-		# ok, the board settled down now
-		submoves = list(paircomb.enumerate_valid_moves())
-		if len(submoves) == 0:
-			subscore = 0
-		else:
-			subscore = submoves[0][1]
-		intermediatescore = 0
-		
-		for type, value in board.events[len(orig_board.events):]:
-			if type == 'activated':
-				intermediatescore += value*10
-			elif type == 'unlocked':
-				intermediatescore += value
-			elif type == 'destroyed':
-				intermediatescore += value
-			elif type == 'combined':
-				intermediatescore += value*20
-		
-		totalscores.append((score + subscore)*10 + intermediatescore)
-
-	numpy.random.set_state(orig_state)
-	board.type = orig_board.type.copy()
-	board.status = orig_board.status.copy()
-	board.color = orig_board.color.copy()
-	board.events = list(orig_board.events)
-	
-	totalscore, (move, _score) = max(zip(totalscores, moves))
-	return move
+def smart_move_selector(board, moves, rng=None, pool=None, cache=None):
+	"""
+	Tries every move and chooses the one with the best outcome,
+	including the best move after it (see gemsearch.LookaheadSearch).
+	The moves are tried in parallel with a *pool* of workers, 
+	e.g. a concurrent.futures.ProcessPoolExecutor. Their outcomes 
+	are kept in *cache* (a TranspositionTable), if given.
+	"""
+	import gemsearch
+	return gemsearch.LookaheadSearch(depth=1, rng=rng, pool=pool, cache=cache)(board, moves)
 
 if __name__ == '__main__':
 	numpy.random.seed(1)
@@ -1072,44 +1958,16 @@ if __name__ == '__main__':
 	paircomb = PairCombiner(board)
 	acto = Activater(board)
 	
+	def show(phase, changes):
+		if changes:
+			print(board, phase)
+			waitfunction()
+	
 	waitfunction()
-	nstep = 0
 	ncomb = 0
 	nswaps = 0
 	while True:
-		# dropping phase
-		while True:
-			nstep += 1
-			print(('STEP %d' % nstep))
-			anychange = grav.run()
-			if anychange: 
-				print(board, 'grav')
-				waitfunction()
-			nstep += 1
-			print(('STEP %d' % nstep))
-			anychange += topfill.run()
-			if anychange: 
-				print(board, 'topfill')
-				waitfunction()
-			if not anychange:
-				break
-		
-		nstep += 1
-		print(('STEP %d: combining phase...' % nstep))
-		# combining phase
-		anychange  = comb.run()
-		if anychange:
-			print(board)
-			waitfunction()
-		nstep += 1
-		print(('STEP %d: activation...' % nstep))
-		anychange += acto.run()
-		if anychange:
-			ncomb += 1
-			nstep += 1
-			print(board)
-			waitfunction()
-			continue
+		ncomb += settle(board, grav, topfill, comb, acto, callback=show)
 		
 		if nswaps >= maxswaps:
 			print('moves used up.')
@@ -1119,13 +1977,12 @@ if __name__ == '__main__':
 			break
 		# ok, the board settled down now
 		# we should ask the agent/user what they want to do now
-		nstep += 1
-		print(('STEP %d: finding valid moves ...' % nstep))
+		print('finding valid moves ...')
 		moves = list(paircomb.enumerate_valid_moves())
 		if len(moves) == 0:
 			# no moves left -- shuffle
-			print(('STEP %d: shuffling ...' % nstep))
-			paircomb.shuffle()
+			print('shuffling ...')
+			paircomb.shuffle(playable=True)
 			print(board)
 			continue
 			
@@ -1135,28 +1992,13 @@ if __name__ == '__main__':
 		# move selector
 		move = move_selector(board, moves)
 		
-		nstep += 1
-		print(('STEP %d: swapping ...' % nstep))
+		print('swapping ...')
 		paircomb.run(*move)
 		nswaps += 1
 		comb.set_last_interaction(*move)
 		print(board)
 
-		nstep += 1
-		print(('STEP %d: combining phase...' % nstep))
-		# combining phase
-		anychange  = comb.run()
-		if anychange:
-			print(board)
-			waitfunction()
-
-		nstep += 1
-		print(('STEP %d: activation...' % nstep))
-		anychange += acto.run()
-		if anychange:
-			nstep += 1
-			print(board)
-			waitfunction()
-			continue
-
+		# combining phase, right after the swap
+		show('comb', comb.run())
+		show('acto', acto.run())
 
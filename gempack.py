@@ -0,0 +1,136 @@
+import os
+import sys
+import numpy
+from gemengine import Board, cell_dtype
+from gemtext import parse_level
+
+# Binary level pack: all levels of a journey in one memory-mapped file.
+#
+# The file starts with a header, followed by the index (one record per
+# level, sorted by game id) and the cell block. Every level occupies
+# nrows x ncols packed cells (of the largest level; smaller levels are
+# padded with non-fields), at the byte offset given in the index.
+# All numbers are little-endian.
+#
+# genlevels.py packs journey-auto after writing its levels; other 
+# journeys are packed with 'python gempack.py <journey> <journey>.pack'.
+# ultragem reads a level from the pack, unless its text file is newer.
+
+pack_magic = b'ULTRAGEM'
+pack_version = 1
+
+header_dtype = numpy.dtype([('magic', 'S8'), ('version', '<u4'), ('nlevels', '<u4'),
+	('nrows', '<u4'), ('ncols', '<u4'), ('index_offset', '<u8'), ('cells_offset', '<u8')])
+
+level_dtype = numpy.dtype([('gameid', '<i4'), ('ncolors', '<i4'), ('maxswaps', '<i4'),
+	('goalid', '<i4'), ('nmin', '<i4'), ('difficulty', '<f4'), ('goalname', 'S16'),
+	('nrows', '<u2'), ('ncols', '<u2'), ('offset', '<u8')])
+
+def write_pack(filename, levels):
+	"""
+	Write a level pack.
+
+	levels is a list of (game id, properties, cells), with the
+	properties as returned by gemtext.parse_level.
+	"""
+	levels = sorted(levels, key=lambda level: level[0])
+	nrows = max([cells.shape[0] for _, _, cells in levels] + [0])
+	ncols = max([cells.shape[1] for _, _, cells in levels] + [0])
+	header = numpy.zeros(1, dtype=header_dtype)
+	index = numpy.zeros(len(levels), dtype=level_dtype)
+	block = numpy.zeros((len(levels), nrows, ncols), dtype=cell_dtype)
+	block['type'] = -1
+	cells_offset = header.nbytes + index.nbytes
+	for k, (gameid, properties, cells) in enumerate(levels):
+		index[k] = (gameid, int(properties['NCOLORS']), int(properties['MAXSWAPS']),
+			int(properties['GOALID']), int(properties['NMIN']), float(properties['DIFFICULTY']),
+			properties.get('GOALNAME', '').encode(), cells.shape[0], cells.shape[1],
+			cells_offset + k * block[0].nbytes)
+		block[k,:cells.shape[0],:cells.shape[1]] = cells
+	header[0] = (pack_magic, pack_version, len(levels), nrows, ncols, header.nbytes, cells_offset)
+	with open(filename, 'wb') as f:
+		f.write(header.tobytes())
+		f.write(index.tobytes())
+		f.write(block.tobytes())
+
+def convert_journey(directory, filename):
+	"""
+	Pack the text levels of a journey directory (files named by game id).
+	"""
+	levels = []
+	for name in os.listdir(directory):
+		if not name.isdigit():
+			continue
+		with open(os.path.join(directory, name)) as f:
+			properties, cells = parse_level(f.read())
+		levels.append((int(name), properties, cells))
+	write_pack(filename, levels)
+	return len(levels)
+
+class LevelPack(object):
+	"""
+	Memory-mapped level pack.
+
+	*levels* is the index (one record per level, see level_dtype),
+	*boards* the cells of all levels as a (nlevels, nrows, ncols) array.
+	Both are read-only views into the file.
+	"""
+	def __init__(self, filename):
+		self.data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+		header = self.data[:header_dtype.itemsize].view(header_dtype)[0]
+		if header['magic'] != pack_magic or header['version'] != pack_version:
+			raise ValueError('%s is not a level pack (version %d)' % (filename, pack_version))
+		nlevels, nrows, ncols = int(header['nlevels']), int(header['nrows']), int(header['ncols'])
+		index_offset, cells_offset = int(header['index_offset']), int(header['cells_offset'])
+		self.levels = self.data[index_offset:index_offset + nlevels * level_dtype.itemsize].view(level_dtype)
+		self.boards = self.data[cells_offset:cells_offset + nlevels * nrows * ncols * cell_dtype.itemsize].view(
+			cell_dtype).reshape((nlevels, nrows, ncols))
+		self.shape = (nrows, ncols)
+
+	def __len__(self):
+		return len(self.levels)
+
+	def __contains__(self, gameid):
+		k = numpy.searchsorted(self.levels['gameid'], gameid)
+		return k < len(self.levels) and self.levels['gameid'][k] == gameid
+
+	def find(self, gameid):
+		"""
+		Position of the level in the pack.
+		"""
+		if gameid not in self:
+			raise KeyError('no level %d' % gameid)
+		return int(numpy.searchsorted(self.levels['gameid'], gameid))
+
+	def properties(self, gameid):
+		"""
+		Properties of the level, with the keys of the text format.
+		"""
+		level = self.levels[self.find(gameid)]
+		return dict(NCOLORS=int(level['ncolors']), MAXSWAPS=int(level['maxswaps']),
+			GOALID=int(level['goalid']), NMIN=int(level['nmin']),
+			DIFFICULTY=float(level['difficulty']), GOALNAME=level['goalname'].decode())
+
+	def cells(self, gameid):
+		"""
+		Cells of the level (a read-only view into the file).
+		"""
+		level = self.levels[self.find(gameid)]
+		offset = int(level['offset'])
+		nrows, ncols = int(level['nrows']), int(level['ncols'])
+		return self.data[offset:offset + self.shape[0] * self.shape[1] * cell_dtype.itemsize].view(
+			cell_dtype).reshape(self.shape)[:nrows,:ncols]
+
+	def board(self, gameid, history=0):
+		"""
+		New board with the cells of the level.
+		"""
+		cells = self.cells(gameid)
+		board = Board(nrows=cells.shape[0], ncols=cells.shape[1], history=history)
+		board.set_cells(cells.copy())
+		return board
+
+if __name__ == '__main__':
+	# usage: python gempack.py journey-auto journey-auto.pack
+	directory, filename = sys.argv[1:]
+	print('packed %d levels into %s' % (convert_journey(directory, filename), filename))
@@ -0,0 +1,436 @@
+import time
+import numpy
+from gemengine import Board, cell_dtype, BoardGravityPuller, Combiner, PairCombiner, Activater, MoveIndex, settle
+from gemengine import CascadeLimitException, combined_codes, random_integers, zobrist_hash
+
+# Lookahead search for move selectors.
+#
+# Moves are played on the board itself, without refilling from the top
+# (the new gems are not known in advance), and reverted through the
+# journal of the board (see Board.mark). The valid moves after a move
+# come from a MoveIndex, which only re-evaluates the changed fields.
+
+def event_gain(before, after):
+	"""
+	Score of the events between two score totals (see EventLog.scores):
+	activations, unlocks and (weighted) combinations of special gems.
+	"""
+	gained = [a - b for a, b in zip(after, before)]
+	return gained[0] + gained[2] + 20 * sum(
+		code * n for code, n in zip(combined_codes, gained[6:]))
+
+# seed of the search without rng
+fixed_seed = 1
+
+# version of the search values kept in a saved cache (see
+# TranspositionTable.save); change it when moves are valued differently
+cache_version = 1
+
+def better_move(best, value, move, score):
+	"""
+	The better of *best*, a (value, (move, score)) tuple or None, and
+	the *move* with its *value* (skipped if None, i.e. pruned). Ties go
+	to the larger move, as with max(). Used by both the serial and the
+	pooled search, so that they choose the same move.
+	"""
+	if value is None or (best is not None and (value, (move, score)) <= best):
+		return best
+	return (value, (move, score))
+
+class SearchTimeout(Exception):
+	"""
+	The time limit of the search was reached.
+	"""
+	pass
+
+def evaluate_moves(task):
+	"""
+	Task of LookaheadSearch with a pool: the moves with their values
+	and the hash of the board after them (see LookaheadSearch.values), 
+	on a board given by its shape and packed cells.
+	"""
+	(shape, cells), moves, depth, beam, prune, seed = task
+	board = Board(nrows=shape[0], ncols=shape[1])
+	board.set_cells(numpy.frombuffer(cells, dtype=cell_dtype).reshape(shape).copy())
+	values = LookaheadSearch(depth, beam, prune).values(board, moves, seed)
+	return [(move, value, settled) for move, (value, settled) in zip(moves, values)]
+
+class LookaheadSearch(object):
+	"""
+	Move selector which looks *depth* moves ahead.
+
+	The value of a move is ten times its score (as listed by
+	valid_moves), plus the score of the events it causes (see event_gain),
+	plus the value of the best following move. At the last ply, ten
+	times the best score of the following moves is added instead.
+
+	At every ply, only the *beam* best moves (by their listed score)
+	are tried (None: all). With prune=True, a move is not searched
+	further if it can not beat the best move found, even if all
+	following moves were as good as the best single move seen so far.
+	This is a heuristic, not a bound: a later move can be worth more
+	than any seen before, so pruning may miss the best move. Results 
+	that are reported as the value of the search should not prune.
+
+	With a *timelimit* (in seconds), the search deepens iteratively,
+	and the move of the deepest finished search is chosen.
+
+	All moves of a ply are tried with the same random numbers, from
+	one stream per ply, spawned from a seed drawn from *rng* (a 
+	numpy.random.Generator or RandomState) on every call. Without
+	*rng*, the seed is fixed, so a board is always searched the same
+	way. The global numpy.random state is not used.
+
+	With a *pool* (e.g. a concurrent.futures.ProcessPoolExecutor, or
+	a ThreadPoolExecutor), the moves are searched in parallel, see 
+	pool_search.
+
+	With a *cache* (a TranspositionTable), the values of the moves are 
+	kept, by Zobrist hash of the board, move and search settings, along 
+	with the hash of the board after the move. Only searches without 
+	pruning are cached. Without *rng*, searching the same board again
+	gives the same values, so these are taken from the cache. A saved
+	cache should be written and loaded with cache_version.
+
+	LookaheadSearch(depth=1) is smart_move_selector.
+	"""
+	def __init__(self, depth=2, beam=None, prune=False, timelimit=None, rng=None, pool=None, cache=None):
+		self.depth = depth
+		self.beam = beam
+		self.prune = prune
+		self.timelimit = timelimit
+		self.rng = rng
+		self.pool = pool
+		self.cache = cache
+		self.nodes = 0
+
+	def __call__(self, board, moves):
+		seed = None if self.rng is None else int(random_integers(self.rng, 2**32))
+		self.fingerprint = None if self.cache is None else zobrist_hash(board)
+		if self.pool is not None:
+			return self.pool_search(board, moves, seed)
+		mark = self.begin(board, seed)
+		start = time.time()
+		try:
+			for depth in range(1, self.depth + 1):
+				if self.timelimit is None and depth < self.depth:
+					continue
+				self.maxvalue = 0
+				try:
+					_, move = self.search(moves, 0, depth, None)
+				except SearchTimeout:
+					board.undo_to(mark)
+					break
+				best = move
+				if self.timelimit is not None:
+					# the first search always finishes
+					self.deadline = start + self.timelimit
+		finally:
+			self.end()
+		return best
+
+	def begin(self, board, seed):
+		"""
+		Prepare searching on *board*, with random numbers from *seed* 
+		(or the fixed seed, if None). Returns the journal mark.
+		"""
+		self.seed = seed
+		self.plyseeds = numpy.random.SeedSequence(fixed_seed if seed is None else seed).spawn(self.depth)
+		self.journaling = board.journal is not None
+		mark = board.mark()
+		self.board = board
+		self.grav = BoardGravityPuller(board)
+		self.comb = Combiner(board)
+		self.paircomb = PairCombiner(board)
+		self.acto = Activater(board)
+		self.moveindex = MoveIndex(board)
+		self.deadline = None
+		self.nodes = 0
+		return mark
+
+	def end(self):
+		"""
+		Undo what begin() changed, other than the board.
+		"""
+		self.moveindex.close()
+		if not self.journaling:
+			self.board.stop_journal()
+
+	def values(self, board, moves, seed):
+		"""
+		Value of each of the moves, searched separately to full depth
+		(so that no move is pruned for another), with the Zobrist hash 
+		of the board after the move.
+		"""
+		mark = self.begin(board, seed)
+		orig_scores = board.events.scores()
+		try:
+			values = []
+			for move, score in moves:
+				self.maxvalue = 0
+				value = self.evaluate(move, score, 0, self.depth, None, orig_scores)
+				values.append((value, zobrist_hash(board)))
+				board.undo_to(mark)
+		finally:
+			self.end()
+		return values
+
+	def pool_search(self, board, moves, seed):
+		"""
+		Search with the *pool* (a concurrent.futures executor), one task
+		per move (see evaluate_moves). The moves are reduced in the same
+		order as in search(), so without pruning, the same move is 
+		chosen as without pool. The time limit does not apply.
+		"""
+		self.board = board
+		self.seed = seed
+		cells = (board.shape, board.cells.tobytes())
+		results = []
+		tasks = []
+		for move, score in moves[:self.beam]:
+			key = self.cache_key(move, self.depth)
+			cached = None if key is None else self.cache.get(key)
+			if cached is None:
+				tasks.append((cells, [(move, score)], self.depth, self.beam, self.prune, seed))
+			else:
+				results.append(((move, score), cached[0]))
+		for task_results in self.pool.map(evaluate_moves, tasks):
+			for (move, score), value, settled in task_results:
+				key = self.cache_key(move, self.depth)
+				if key is not None:
+					self.cache.put(key, (value, settled))
+				results.append(((move, score), value))
+		best = None
+		for (move, score), value in results:
+			best = better_move(best, value, move, score)
+		value, (move, _score) = best
+		return move
+
+	def play(self, move, ply):
+		"""
+		Play a move and let the board settle down (without refilling).
+		"""
+		# the same numbers for every move of the ply
+		rollout_rng = numpy.random.default_rng(self.plyseeds[ply])
+		self.grav.rng = self.comb.rng = self.paircomb.rng = self.acto.rng = rollout_rng
+		self.paircomb.run(*move)
+		self.comb.set_last_interaction(*move)
+		anychange  = self.comb.run()
+		anychange += self.acto.run()
+		if anychange:
+			settle(self.board, self.grav, None, self.comb, self.acto)
+
+	def search(self, moves, ply, depth, alpha):
+		"""
+		Value of the best of the *moves* (which are listed best first),
+		looking depth - ply moves ahead, and that move.
+
+		Moves which can not exceed *alpha* may be pruned; if all are,
+		the value is None.
+		"""
+		if self.deadline is not None and time.time() > self.deadline:
+			raise SearchTimeout()
+		board = self.board
+		mark = board.mark()
+		orig_scores = board.events.scores()
+		best = None
+		for move, score in moves[:self.beam]:
+			# what the move has to beat
+			bound = [v for v in (alpha, best and best[0]) if v is not None]
+			bound = max(bound) if bound else None
+			key = self.cache_key(move, depth) if ply == 0 else None
+			cached = None if key is None else self.cache.get(key)
+			if cached is not None:
+				value, _settled = cached
+			else:
+				value = self.evaluate(move, score, ply, depth, bound, orig_scores)
+				if key is not None:
+					self.cache.put(key, (value, zobrist_hash(board)))
+				board.undo_to(mark)
+			best = better_move(best, value, move, score)
+		if best is None:
+			return None, None
+		value, (move, _score) = best
+		return value, move
+
+	def evaluate(self, move, score, ply, depth, bound, orig_scores):
+		"""
+		Play a move and return its value (see search), or None if it 
+		can not exceed *bound* and is pruned. The move is not undone.
+		"""
+		self.nodes += 1
+		self.play(move, ply)
+		value = score * 10 + event_gain(orig_scores, self.board.events.scores())
+		submoves = list(self.moveindex.enumerate_valid_moves())
+		if ply + 1 == depth:
+			value += submoves[0][1] * 10 if submoves else 0
+			self.maxvalue = max(self.maxvalue, value)
+		elif submoves:
+			self.maxvalue = max(self.maxvalue, value)
+			if self.prune and bound is not None and value + (depth - ply - 1) * self.maxvalue < bound:
+				return None
+			subvalue, _ = self.search(submoves, ply + 1, depth, None if bound is None else bound - value)
+			value = None if subvalue is None else value + subvalue
+		return value
+
+	def cache_key(self, move, depth):
+		"""
+		Key of a move from the searched board in the *cache*, or None
+		if the value of the move is not cached (pruned searches depend
+		on the order of the moves, and are not).
+		"""
+		if self.cache is None or self.prune:
+			return None
+		return (self.board.shape, self.fingerprint, move, depth, self.beam, self.seed)
+
+class SearchNode(object):
+	"""
+	Statistics of a sequence of moves in the Monte Carlo search tree:
+	the number of rollouts through it, their total reward, and the 
+	nodes of the moves after it.
+	"""
+	def __init__(self):
+		self.visits = 0
+		self.reward = 0.
+		self.children = {}
+
+class MonteCarloSearch(object):
+	"""
+	Move selector based on Monte Carlo tree search (UCT).
+
+	Every rollout plays moves on the board, with refills from the top
+	(by a *filler* like NastyTopFiller, created with *filler_args*,
+	which should be those of the game's filler, e.g. whole_columns),
+	for up to *horizon* moves, and reverts them through the journal 
+	of the board. The reward is the gain in game score. Each rollout
+	draws its random numbers (refill, gravity, special gems) from a 
+	new independent stream, spawned from a seed taken from *rng*
+	(a numpy.random.Generator or RandomState, or the numpy.random module).
+
+	The tree is over move sequences (open loop): the moves are chosen 
+	by the upper confidence bound, with *exploration* weight, among 
+	those valid on the sampled board; untried moves first, in the order 
+	listed. Past the tree, moves are chosen at random.
+
+	Per call, *rollouts* rollouts are made, or as many as fit into 
+	*timelimit* seconds (if given). The move tried most is chosen.
+	Called again on the same position (by Zobrist hash), the tree is 
+	kept and searched further. Called on the next position of the same
+	board, the subtree of the chosen move is reused (this assumes the
+	move was played), keeping only the moves which are valid there.
+	Otherwise, the search starts anew.
+	"""
+	def __init__(self, filler, rollouts=100, timelimit=None, horizon=3, exploration=1.4, rng=None, **filler_args):
+		self.filler = filler
+		self.filler_args = filler_args
+		self.rollouts = rollouts
+		self.timelimit = timelimit
+		self.horizon = horizon
+		self.exploration = exploration
+		self.rng = numpy.random if rng is None else rng
+		self.board = None
+		self.root = None
+		self.next_root = None
+		self.fingerprint = None
+		self.scale = 1.
+
+	def __call__(self, board, moves):
+		fingerprint = (board.shape, zobrist_hash(board))
+		if self.root is not None and fingerprint == self.fingerprint:
+			root = self.root
+		elif self.next_root is not None and board is self.board:
+			# the tree is open loop, its statistics are over the refills
+			root = self.next_root
+			valid = set(move for move, _score in moves)
+			root.children = dict((move, child) for move, child in root.children.items() if move in valid)
+		else:
+			root = SearchNode()
+		self.board = board
+		self.root = root
+		self.next_root = None
+		self.fingerprint = fingerprint
+		seeds = numpy.random.SeedSequence(random_integers(self.rng, 2**31))
+		journaling = board.journal is not None
+		self.grav = BoardGravityPuller(board)
+		self.comb = Combiner(board)
+		self.paircomb = PairCombiner(board)
+		self.acto = Activater(board, chain=True)
+		self.topfill = self.filler(board, **self.filler_args)
+		self.moveindex = MoveIndex(board)
+		deadline = None if self.timelimit is None else time.time() + self.timelimit
+		n = 0
+		try:
+			while (n < self.rollouts) if deadline is None else (time.time() < deadline):
+				self.rollout(root, moves, numpy.random.default_rng(seeds.spawn(1)[0]))
+				n += 1
+		finally:
+			self.moveindex.close()
+			if not journaling:
+				board.stop_journal()
+		self.nrollouts = n
+		
+		candidates = [(move, root.children[move]) for move, _score in moves if move in root.children]
+		if not candidates:
+			return moves[0][0]
+		move, node = max(candidates, key=lambda candidate: 
+			(candidate[1].visits, candidate[1].reward / candidate[1].visits))
+		# continue from here after the move
+		self.next_root = node
+		return move
+
+	def select(self, node, moves):
+		"""
+		The move to play from a tree node (see class documentation).
+		"""
+		for move, _score in moves:
+			if move not in node.children:
+				return move
+		logvisits = numpy.log(max(1, sum(node.children[move].visits for move, _score in moves)))
+		def bound(move):
+			child = node.children[move]
+			return child.reward / child.visits / self.scale + \
+				self.exploration * (logvisits / child.visits)**0.5
+		return max((move for move, _score in moves), key=bound)
+
+	def rollout(self, root, moves, rng):
+		"""
+		Play one rollout from the root, and record its reward in the
+		tree nodes passed through. Adds one node to the tree.
+		"""
+		board = self.board
+		self.grav.rng = self.comb.rng = self.paircomb.rng = self.acto.rng = self.topfill.rng = rng
+		mark = board.mark()
+		orig_score = board.events.scores()[0]
+		node = root
+		path = [root]
+		for depth in range(self.horizon):
+			if not moves:
+				break
+			if node is None:
+				move, _score = moves[random_integers(rng, len(moves))]
+			else:
+				move = self.select(node, moves)
+				if move not in node.children:
+					node.children[move] = SearchNode()
+					node = node.children[move]
+					path.append(node)
+					# leave the tree after adding a node
+					node = None
+				else:
+					node = node.children[move]
+					path.append(node)
+			self.paircomb.run(*move)
+			self.comb.set_last_interaction(*move)
+			self.comb.run()
+			self.acto.run()
+			try:
+				settle(board, self.grav, self.topfill, self.comb, self.acto)
+			except CascadeLimitException:
+				break
+			moves = list(self.moveindex.enumerate_valid_moves())
+		reward = board.events.scores()[0] - orig_score
+		self.scale = max(self.scale, reward)
+		for node in path:
+			node.visits += 1
+			node.reward += reward
+		board.undo_to(mark)
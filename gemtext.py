@@ -0,0 +1,150 @@
+import functools
+import numpy
+from gemengine import Board, cell_dtype, cell_codes, ncellcodes
+
+# Text format of boards, as written by Board.__str__ and stored in levels.
+#
+# Every field takes four characters: two for the gem (' X' non-field,
+# '  ' empty, ' B'/' b' double-locked/locked empty field, ' 3' simple gem
+# of color 3, '=3' horizontal stripe, '|3' vertical stripe, 'X3' bomb,
+# '# ' zapper), then 'L'/'l' for double-locked/locked fields or ' ',
+# then a space. Each row is one line.
+#
+# Both directions go through lookup tables, for all fields at once.
+# The tables cover the colors 0..9 (one digit); boards with other 
+# colors are written field by field, as Board.__str__ always did.
+
+def _field_text(type, color, status):
+	if type == -1:
+		t = ' X'
+	elif type == 0:
+		if status == 2:
+			t = ' B'
+		elif status == 1:
+			t = ' b'
+		else:
+			t = '  '
+	elif type == 5:
+		t = '# '
+	else:
+		t = ' =|X'[type - 1] + '%d' % color
+	if status == 2:
+		s = 'L'
+	elif status == 1:
+		s = 'l'
+	else:
+		s = ' '
+	return t + s + ' '
+
+@functools.lru_cache(maxsize=1)
+def format_table():
+	"""
+	Text of every field with a one-digit color, as a (280, 4) uint8 
+	array indexed by cell_codes() * 10 + color.
+	"""
+	table = numpy.zeros((ncellcodes * 10, 4), dtype=numpy.uint8)
+	for type in range(-1, 6):
+		for color in range(10):
+			for status in range(-1, 3):
+				cell = numpy.array((type, color, status), dtype=cell_dtype)
+				table[cell_codes(cell) * 10 + color] = numpy.frombuffer(
+					_field_text(type, color, status).encode(), dtype=numpy.uint8)
+	table.flags.writeable = False
+	return table
+
+@functools.lru_cache(maxsize=1)
+def parse_table():
+	"""
+	Field of every two-character gem text, as a (256, 256) array of
+	packed cells indexed by the character codes (unknown texts have 
+	type -2), and the status set by the third character (or -1).
+	"""
+	fields = numpy.zeros((256, 256), dtype=cell_dtype)
+	fields['type'] = -2
+	for text, field in ('  ', (0, 0, 0)), (' X', (-1, 0, 0)), (' B', (0, 0, 2)), (' b', (0, 0, 1)), ('# ', (5, 0, 0)):
+		fields[ord(text[0]), ord(text[1])] = field
+	for type, c in enumerate(' =|X', 1):
+		for color in range(10):
+			fields[ord(c), ord('0') + color] = (type, color, 0)
+	locks = numpy.zeros(256, dtype=numpy.int8) - 1
+	locks[ord('l')] = 1
+	locks[ord('L')] = 2
+	fields.flags.writeable = False
+	locks.flags.writeable = False
+	return fields, locks
+
+def format_cells(cells):
+	"""
+	Text of a board (without header line), from its packed cells.
+	"""
+	nrows, ncols = cells.shape
+	# only gems show their color
+	gem = numpy.logical_and(cells['type'] >= 1, cells['type'] <= 4)
+	color = numpy.where(gem, cells['color'], 0)
+	if numpy.logical_or(color < 0, color > 9).any():
+		return ''.join(''.join(_field_text(type, color, status) 
+			for type, color, status in row.tolist()) + '\n' for row in cells)
+	chars = numpy.empty((nrows, ncols * 4 + 1), dtype=numpy.uint8)
+	chars[:,:-1] = format_table()[cell_codes(cells) * 10 + color].reshape((nrows, ncols * 4))
+	chars[:,-1] = ord('\n')
+	return chars.tobytes().decode()
+
+def format_board(board):
+	"""
+	Text of a board, with a 'BOARD: <rows>x<columns>' header line.
+	"""
+	return 'BOARD: %dx%d\n' % board.shape + format_cells(board.cells)
+
+def parse_cells(lines, nrows, ncols):
+	"""
+	Packed cells of a board from its text lines (without header line).
+	Lines may be shorter than the board; missing fields are empty.
+	"""
+	width = ncols * 4
+	rows = [line.rstrip('\n').ljust(width)[:width] for line in lines[:nrows]]
+	rows += [' ' * width] * (nrows - len(rows))
+	chars = numpy.frombuffer(''.join(rows).encode(), dtype=numpy.uint8).reshape((nrows, ncols, 4))
+	fields, locks = parse_table()
+	cells = fields[chars[:,:,0], chars[:,:,1]]
+	if (cells['type'] == -2).any():
+		j, i = numpy.argwhere(cells['type'] == -2)[0]
+		raise ValueError('invalid field "%s" at %d,%d' % (chars[j,i].tobytes().decode(), j, i))
+	lock = locks[chars[:,:,2]]
+	cells['status'] = numpy.where(lock >= 0, lock, cells['status'])
+	return cells
+
+def parse_header(line):
+	"""
+	Board shape (rows, columns) from a 'BOARD: <rows>x<columns>' line.
+	"""
+	key, value = line.split(':')
+	if key.strip().upper() != 'BOARD':
+		raise ValueError('expected board header, got "%s"' % line.strip())
+	nrows, ncols = value.split('x')
+	return int(nrows), int(ncols)
+
+def parse_board(text, history=0):
+	"""
+	Board from its text, as produced by format_board.
+	"""
+	lines = text.split('\n')
+	nrows, ncols = parse_header(lines[0])
+	board = Board(nrows=nrows, ncols=ncols, history=history)
+	board.set_cells(parse_cells(lines[1:], nrows, ncols))
+	return board
+
+def parse_level(text):
+	"""
+	Level properties and board cells from the text of a level file:
+	'KEY: value' lines (the keys are returned in upper case),
+	followed by the board.
+	"""
+	lines = text.split('\n')
+	properties = {}
+	for k, line in enumerate(lines):
+		key, value = line.split(':', 1)
+		if key.upper() == 'BOARD':
+			nrows, ncols = parse_header(line)
+			return properties, parse_cells(lines[k+1:], nrows, ncols)
+		properties[key.upper()] = value.strip()
+	raise ValueError('level has no board')
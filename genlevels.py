@@ -1,6 +1,8 @@
 import matplotlib.pyplot as plt
 import numpy
 import sys
+from gemtext import format_board, parse_board
+from gempack import convert_journey
 
 numpy.random.seed(1)
 scores = ['score', 'ndestroyed', 'nunlocked', 
@@ -23,7 +25,8 @@ for filename in sys.argv[1:]:
 	best = numpy.loadtxt(filename + '/best.txt', dtype=int).reshape((-1, 2, 13))
 	random = numpy.loadtxt(filename + '/random.txt', dtype=int).reshape((-1, 2, 13))
 	smart = numpy.loadtxt(filename + '/smart.txt', dtype=int).reshape((-1, 2, 13))
-	board = open(filename + '/board.txt').read()
+	# normalise the board text (and check that it is valid)
+	board = format_board(parse_board(open(filename + '/board.txt').read()))
 	used = False
 	for scoregroup in scores_preferences:
 		js = [scores.index(scorename) for scorename in scoregroup]
@@ -119,4 +122,5 @@ while game_sequence:
 		f.write(board)
 print()
 print(len(game_sequence))
+print('packed %d levels' % convert_journey('journey-auto', 'journey-auto.pack'))
 
@@ -58,51 +58,19 @@ def run_scenario(scenario):
 	acto = Activater(board)
 	check_board(test_steps, steps, before, board.copy())
 	
-	nstep = 0
+	def check_phase(phase, changes):
+		if changes:
+			print(board, phase)
+			waitfunction()
+		check_board(test_steps, steps, state['before'], board.copy())
+		state['before'] = board.copy()
+	
+	state = {}
 	ncomb = 0
 	nswaps = 0
 	while True:
-		# dropping phase
-		while True:
-			nstep += 1
-			print(('STEP %d' % nstep))
-			before = board.copy()
-			anychange = grav.run()
-			if anychange: 
-				print(board, 'grav')
-				waitfunction()
-			check_board(test_steps, steps, before, board.copy())
-			nstep += 1
-			print(('STEP %d' % nstep))
-			before = board.copy()
-			anychange += topfill.run()
-			check_board(test_steps, steps, before, board.copy())
-			if anychange: 
-				print(board, 'topfill')
-				waitfunction()
-			if not anychange:
-				break
-		
-		nstep += 1
-		print(('STEP %d: combining phase...' % nstep))
-		before = board.copy()
-		# combining phase
-		anychange  = comb.run()
-		check_board(test_steps, steps, before, board.copy())
-		if anychange:
-			print(board)
-			waitfunction()
-		nstep += 1
-		print(('STEP %d: activation...' % nstep))
-		before = board.copy()
-		anychange += acto.run()
-		check_board(test_steps, steps, before, board.copy())
-		if anychange:
-			ncomb += 1
-			nstep += 1
-			print(board)
-			waitfunction()
-			continue
+		state['before'] = board.copy()
+		ncomb += settle(board, grav, topfill, comb, acto, callback=check_phase)
 		
 		if nswaps >= maxswaps:
 			print('moves used up.')
@@ -112,14 +80,13 @@ def run_scenario(scenario):
 			break
 		# ok, the board settled down now
 		# we should ask the agent/user what they want to do now
-		nstep += 1
-		print(('STEP %d: finding valid moves ...' % nstep))
+		print('finding valid moves ...')
 		before = board.copy()
 		moves = list(paircomb.enumerate_valid_moves())
 		check_board(test_steps, steps, before, board.copy())
 		if len(moves) == 0:
 			# no moves left -- shuffle
-			print(('STEP %d: shuffling ...' % nstep))
+			print('shuffling ...')
 			paircomb.shuffle()
 			print(board)
 			continue
@@ -130,8 +97,7 @@ def run_scenario(scenario):
 		# move selector
 		move = move_selector(board, moves)
 		
-		nstep += 1
-		print(('STEP %d: swapping ...' % nstep))
+		print('swapping ...')
 		before = board.copy()
 		paircomb.run(*move)
 		check_board(test_steps, steps, before, board.copy())
@@ -139,26 +105,10 @@ def run_scenario(scenario):
 		comb.set_last_interaction(*move)
 		print(board)
 
-		nstep += 1
-		print(('STEP %d: combining phase...' % nstep))
-		# combining phase
-		before = board.copy()
-		anychange  = comb.run()
-		check_board(test_steps, steps, before, board.copy())
-		if anychange:
-			print(board)
-			waitfunction()
-
-		nstep += 1
-		print(('STEP %d: activation...' % nstep))
-		before = board.copy()
-		anychange += acto.run()
-		check_board(test_steps, steps, before, board.copy())
-		if anychange:
-			nstep += 1
-			print(board)
-			waitfunction()
-			continue
+		# combining phase, right after the swap
+		state['before'] = board.copy()
+		check_phase('comb', comb.run())
+		check_phase('acto', acto.run())
 	
 	# store 
 	numpy.save('testdata_%s_proposed.npy' % scenario, numpy.array([[prevboard.type,prevboard.color,prevboard.status,nextboard.type,nextboard.color,nextboard.status] for prevboard, nextboard in steps]))
@@ -0,0 +1,86 @@
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from gemengine import *
+from gemtext import format_board, parse_board
+from gemsearch import LookaheadSearch, MonteCarloSearch
+
+def test_large_colors():
+	# colors 7 and up must not be mistaken for other gem types
+	board = Board(nrows=1, ncols=4)
+	board.type[:] = [1, 1, 2, 4]
+	board.color[:] = [7, 8, 7, 9]
+	assert str(board) == 'BOARD: 1x4\n 7   8  =7  X9  \n', str(board)
+	assert parse_board(format_board(board)) == board
+	# two digit colors are written field by field
+	board.color[0,3] = 12
+	assert str(board) == 'BOARD: 1x4\n 7   8  =7  X12  \n', str(board)
+	a = Board(nrows=1, ncols=1)
+	a.type[:] = 1
+	a.color[:] = 7
+	b = Board(nrows=1, ncols=1)
+	b.type[:] = 2
+	b.color[:] = 0
+	assert zobrist_hash(a) != zobrist_hash(b)
+	# incremental hashing agrees
+	hasher = ZobristHash(a)
+	a.touch(Ellipsis)
+	a.color[:] = 100
+	assert hasher.hash() == zobrist_hash(a)
+
+def search_board(seed=1):
+	board = Board(nrows=8, ncols=8)
+	board.type[:] = 1
+	board.color[:] = numpy.random.RandomState(seed).randint(1, 5, size=(8, 8))
+	settle(board, BoardGravityPuller(board), None, Combiner(board), Activater(board))
+	return board, list(PairCombiner(board).enumerate_valid_moves())
+
+def test_prune():
+	# pruning skips moves, but finds the same move on this board
+	board, moves = search_board()
+	full = LookaheadSearch(depth=3, beam=4)
+	pruned = LookaheadSearch(depth=3, beam=4, prune=True)
+	assert full(board, moves) == pruned(board, moves) == (7, 3, 6, 3)
+	assert pruned.nodes < full.nodes, (pruned.nodes, full.nodes)
+
+def test_pool():
+	# the same move, also among equally good ones (board 6 has four)
+	with ThreadPoolExecutor(4) as pool:
+		for seed, depth in [(1, 2), (6, 1), (6, 2)]:
+			board, moves = search_board(seed)
+			serial = LookaheadSearch(depth=depth)(board, moves)
+			pooled = LookaheadSearch(depth=depth, pool=pool)(board, moves)
+			assert serial == pooled, (seed, depth, serial, pooled)
+
+def test_mcts_reuse():
+	# after the chosen move is played, its subtree is the new root
+	board, moves = search_board()
+	rng = numpy.random.RandomState(1)
+	search = MonteCarloSearch(NastyTopFiller, rollouts=30, ncolors=4, rng=rng)
+	move = search(board, moves)
+	subtree = search.next_root
+	grav = BoardGravityPuller(board)
+	comb = Combiner(board)
+	paircomb = PairCombiner(board)
+	acto = Activater(board, chain=True)
+	paircomb.run(*move)
+	comb.set_last_interaction(*move)
+	comb.run()
+	acto.run()
+	settle(board, grav, NastyTopFiller(board, ncolors=4, rng=rng), comb, acto)
+	moves = list(PairCombiner(board).enumerate_valid_moves())
+	visits = subtree.visits
+	search(board, moves)
+	assert search.root is subtree and visits > 0
+	assert search.root.visits == visits + 30
+	assert set(search.root.children) <= set(move for move, _score in moves)
+	# a different board starts anew
+	other, moves = search_board(6)
+	search(other, moves)
+	assert search.root.visits == 30
+
+if __name__ == '__main__':
+	test_large_colors()
+	test_prune()
+	test_pool()
+	test_mcts_reuse()
+	print('all tests passed')
@@ -30,14 +30,19 @@ import random
 import time
 import pygame
 import sys
+import os
 import copy
 import numpy
 from pygame.locals import QUIT, KEYUP, K_ESCAPE, K_BACKSPACE, MOUSEBUTTONUP, MOUSEBUTTONDOWN
-from gemengine import Board, InitialFillerDoubleLockSpecial, InitialFillerDoubleLock, InitialFillerDisable, NastyTopFiller, BoardGravityPuller, Combiner, PairCombiner, Activater
+from gemtext import parse_level
+from gempack import LevelPack
+from gemsearch import LookaheadSearch
+from gemengine import Board, EventLog, settle, InitialFillerDoubleLockSpecial, InitialFillerDoubleLock, InitialFillerDisable, NastyTopFiller, BoardGravityPuller, Combiner, PairCombiner, Activater, MoveIndex
 
 FPS = 60 # frames per second to update the screen
 HINTFPS = FPS / 10
 SCOREFPS = FPS / 20
+HINTTIME = 0.3 # seconds to search for the hinted move
 WINDOWWIDTH = 400  # width of the program's window, in pixels
 WINDOWHEIGHT = 400 # height in pixels
 
@@ -83,6 +88,7 @@ class UltraGemGame(object):
 		self.gameid = gameid
 		self.ncolors = 6
 		self.journey = 'journey-auto'
+		self.levelpack = None
 
 		self.setBoardSize(8,8)
 		self.rng = numpy.random
@@ -186,8 +192,7 @@ class UltraGemGame(object):
 				self.last_move = None, None, None, None
 				self.nswaps = 0
 				self.boardlog = []
-				self.score = self.scoring_function([])
-				self.events_processed = 0
+				self.score = EventLog().scores()
 				self.initGame()
 				self.runGame()
 				success = self.score[self.goalid] >= self.goalvalue
@@ -204,7 +209,7 @@ class UltraGemGame(object):
 	def setupGame(self, seed):
 		nrows, ncols, ncolors = self.BOARDWIDTH, self.BOARDHEIGHT, self.ncolors
 		rng = numpy.random.RandomState(seed)
-		board = Board(nrows=nrows, ncols=ncols)
+		board = Board(nrows=nrows, ncols=ncols, history=1000)
 		# make lower numbers more likely to be selected
 		prows = 1. / (0.2 + numpy.arange(nrows))
 		prows /= prows.sum()
@@ -221,7 +226,7 @@ class UltraGemGame(object):
 			InitialFillerDoubleLock(board, nrows=ndlrows, ncols=ndlcols, rng=rng).run()
 		if rng.uniform() < 0.1:
 			InitialFillerDisable(board, nrows=ndrows, ncols=ndcols, rng=rng).run()
-		topfill = NastyTopFiller(board, ncolors=ncolors)
+		topfill = NastyTopFiller(board, ncolors=ncolors, rng=self.rng)
 		return board, topfill
 
 	def setupUniqueGame(self, seed):
@@ -235,84 +240,46 @@ class UltraGemGame(object):
 	
 	def loadGame(self, gameid):
 		self.BOARDWIDTH, self.BOARDHEIGHT, self.ncolors = None, None, None
-		with open('%s/%d' % (self.journey, gameid)) as f:
-			gameprops = {}
-			for line in f:
-				key, value = line.split(':')
-				gameprops[key] = value
-				key = key.upper()
-				if key == 'NCOLORS':
-					self.ncolors = int(value)
-				elif key == 'MAXSWAPS':
-					self.maxswaps = int(value)
-				elif key == 'GOALID':
-					self.goalid = int(value)
-				elif key == 'NMIN':
-					self.goalvalue = int(value)
-				elif key == 'DIFFICULTY':
-					d = float(value)
-					if d < 0.2:
-						self.difficulty_text = 'SUPER EASY'
-					elif d < 0.5:
-						self.difficulty_text = 'EASY'
-					elif d < 0.75:
-						self.difficulty_text = 'HARD'
-					elif d < 1.0:
-						self.difficulty_text = 'VERY HARD'
-					else:
-						self.difficulty_text = 'EXTREME'
-				elif key == 'BOARD':
-					a, b = value.split('x')
-					self.setBoardSize(int(a), int(b))
-					break
-			
-			nrows, ncols, ncolors = self.BOARDWIDTH, self.BOARDHEIGHT, self.ncolors
-			board = Board(nrows=nrows, ncols=ncols)
-			for i, line in enumerate(f):
-				#print('parsing line', line)
-				for k in range(self.BOARDWIDTH):
-					txt = line[k*4:(k+1)*4]
-					#print('parsing chunk: "%s"' % txt)
-					type = 0
-					color = 0
-					status = 0
-					if txt == '    ':
-						# empty
-						pass
-					elif txt[1] == 'X':
-						type = -1
-					elif txt[1] == 'B':
-						status = 2
-						type = 0
-					elif txt[1] == 'b':
-						status = 1
-						type = 0
-					elif txt[0] == ' ':
-						type = 1
-						color = int(txt[1])
-					elif txt[0] == '=':
-						type = 2
-						color = int(txt[1])
-					elif txt[0] == '|':
-						type = 3
-						color = int(txt[1])
-					elif txt[0] == 'X':
-						type = 4
-						color = int(txt[1])
-					elif txt[0] == '#':
-						type = 5
-						color = 0
-					if txt[2] == 'L':
-						status = 2
-					elif txt[2] == 'l':
-						status = 1
-					
-					board.type[i,k] = type
-					board.color[i,k] = color
-					board.status[i,k] = status
-				
-			topfill = NastyTopFiller(board, ncolors=ncolors)
-			return board, topfill
+		levelfile = '%s/%d' % (self.journey, gameid)
+		packfile = self.journey + '.pack'
+		# packed levels (see gempack), unless the level was written after the pack
+		if os.path.exists(packfile) and not (os.path.exists(levelfile) and 
+				os.path.getmtime(levelfile) > os.path.getmtime(packfile)):
+			if self.levelpack is None:
+				self.levelpack = LevelPack(packfile)
+			# the board gets its own copy of the (read-only) cells
+			gameprops, cells = self.levelpack.properties(gameid), self.levelpack.cells(gameid).copy()
+		else:
+			with open(levelfile) as f:
+				gameprops, cells = parse_level(f.read())
+		for key, value in gameprops.items():
+			if key == 'NCOLORS':
+				self.ncolors = int(value)
+			elif key == 'MAXSWAPS':
+				self.maxswaps = int(value)
+			elif key == 'GOALID':
+				self.goalid = int(value)
+			elif key == 'NMIN':
+				self.goalvalue = int(value)
+			elif key == 'DIFFICULTY':
+				d = float(value)
+				if d < 0.2:
+					self.difficulty_text = 'SUPER EASY'
+				elif d < 0.5:
+					self.difficulty_text = 'EASY'
+				elif d < 0.75:
+					self.difficulty_text = 'HARD'
+				elif d < 1.0:
+					self.difficulty_text = 'VERY HARD'
+				else:
+					self.difficulty_text = 'EXTREME'
+		self.setBoardSize(*cells.shape)
+		
+		nrows, ncols = cells.shape
+		board = Board(nrows=nrows, ncols=ncols, history=1000)
+		board.set_cells(cells)
+		topfill = NastyTopFiller(board, ncolors=self.ncolors, rng=self.rng)
+		return board, topfill
 	
 	def initGame(self):
 		#board, topfill = self.setupUniqueGame(self.gameid)
@@ -321,89 +288,74 @@ class UltraGemGame(object):
 		rng = self.rng
 		self.board = board
 		self.topfill = topfill
-		self.grav = BoardGravityPuller(board)
-		self.comb = Combiner(board)
-		self.paircomb = PairCombiner(board)
-		self.acto = Activater(board)
+		self.grav = BoardGravityPuller(board, rng=rng)
+		self.comb = Combiner(board, rng=rng)
+		self.paircomb = PairCombiner(board, rng=rng)
+		self.moveindex = MoveIndex(board)
+		self.acto = Activater(board, chain=True, rng=rng)
+
+	def animatePhase(self, board, points, phase, changes):
+		self.gameLog(phase, self.board.copy())
+		if phase == 'grav':
+			print(self.board)
+			self.movingGems = []
+			#print('grav changes:', changes)
+			for j, i, move in changes:
+				if move == 'dropped from top':
+					directionx = 0
+					directiony = 1
+				elif move == 'dropped from top-left':
+					directionx = 1
+					directiony = 1
+				elif move == 'dropped from top-right':
+					directionx = -1
+					directiony = 1
+				else:
+					assert False, move 
+				assert self.getImageNum(j,i) != -1
+				self.movingGems.append(dict(imageNum=self.getImageNum(j,i), 
+					x=i-directionx, y=j-directiony, 
+					directionx=directionx, directiony=directiony))
+		elif phase == 'topfill':
+			#print('topfill changes:', changes)
+			print(self.board)
+			movingGems = self.movingGems
+			for j, i, move in changes:
+				directionx = 0
+				directiony = 1
+				assert self.getImageNum(j,i) != -1
+				movingGems.append(dict(imageNum=self.getImageNum(j,i), 
+					x=i-directionx, y=j-directiony, 
+					directionx=directionx, directiony=directiony))
+
+			if movingGems:
+				#print('moving gems:', movingGems)
+				boardCopy = self.getBoardCopyMinusGems(board, movingGems)
+				self.animateMovingGems(boardCopy, movingGems, points)
+				#self.moveGems(board, movingGems)
+				self.updateBoard(board)
+		elif changes:
+			# combined or activated:
+			# have to find the differences and transition
+			# using fire
+			boardCopy = copy.deepcopy(board)
+			self.updateBoard(board)
+			print(self.board)
+			self.transitionBoard(boardCopy, board)
 
 	def fillBoardAndAnimate(self, board, points=None):
-		# dropping phase
-		anychange = True
 		nshuffles = 0
 		self.gameLog('fillBoardAndAnimate', self.board.copy())
 		print(self.board)
+		animate = lambda phase, changes: self.animatePhase(board, points, phase, changes)
 		while True:
-			while anychange:
-				changes = self.grav.run()
-				anychange = len(changes) > 0
-				movingGems = []
-				#print('grav changes:', changes, anychange)
-				self.gameLog('grav', self.board.copy())
-				print(self.board)
-				for j, i, move in changes:
-					if move == 'dropped from top':
-						directionx = 0
-						directiony = 1
-					elif move == 'dropped from top-left':
-						directionx = 1
-						directiony = 1
-					elif move == 'dropped from top-right':
-						directionx = -1
-						directiony = 1
-					else:
-						assert False, move 
-					assert self.getImageNum(j,i) != -1
-					movingGems.append(dict(imageNum=self.getImageNum(j,i), 
-						x=i-directionx, y=j-directiony, 
-						directionx=directionx, directiony=directiony))
-
-				changes = self.topfill.run()
-				anychange = len(changes) > 0 or anychange
-				#print('topfill changes:', changes, anychange)
-				self.gameLog('topfill', self.board.copy())
-				print(self.board)
-				for j, i, move in changes:
-					directionx = 0
-					directiony = 1
-					assert self.getImageNum(j,i) != -1
-					movingGems.append(dict(imageNum=self.getImageNum(j,i), 
-						x=i-directionx, y=j-directiony, 
-						directionx=directionx, directiony=directiony))
-
-				if movingGems:
-					#print('moving gems:', movingGems)
-					boardCopy = self.getBoardCopyMinusGems(board, movingGems)
-					self.animateMovingGems(boardCopy, movingGems, points)
-					#self.moveGems(board, movingGems)
-					self.updateBoard(board)
-				#print('board now:', board)
-			#print('final board:', board)
-			
-			# combining phase
-			anychange = self.comb.run()
-			self.gameLog('comb', self.board.copy())
-			if anychange:
-				# have to find the differences and transition
-				# using fire
-				boardCopy = copy.deepcopy(board)
-				self.updateBoard(board)
-				print(self.board)
-				self.transitionBoard(boardCopy, board)
-			
-			#print(('STEP %d: activation...' % nstep))
-			anychange = self.acto.run() or anychange
-			self.gameLog('acto', self.board.copy())
-			if anychange:
-				boardCopy = copy.deepcopy(board)
-				self.updateBoard(board)
-				print(self.board)
-				self.transitionBoard(boardCopy, board)
-				continue
+			# dropping, combining and activating until nothing changes
+			settle(self.board, self.grav, self.topfill, self.comb, self.acto, callback=animate)
 			
 			# ok, the board settled down now
 			# we should ask the agent/user what they want to do now
 			#print(('STEP %d: finding valid moves ...' % nstep))
-			moves = list(self.paircomb.enumerate_valid_moves())
+			moves = list(self.moveindex.enumerate_valid_moves())
 			if len(moves) == 0:
 				# no moves left -- shuffle
 				#print(('shuffling ...'))
@@ -411,7 +363,7 @@ class UltraGemGame(object):
 				if nshuffles > 20:
 					raise GameInvalidException('Too many shuffles')
 				boardCopy = copy.deepcopy(board)
-				self.paircomb.shuffle()
+				self.paircomb.shuffle(playable=True)
 				self.gameLog('paircomb.shuffle', self.board.copy())
 				self.updateBoard(board)
 				self.transitionBoard(boardCopy, board, type='glance')
@@ -431,24 +383,8 @@ class UltraGemGame(object):
 		print(self.board)
 
 		# combining phase
-		anychange = self.comb.run()
-		self.gameLog('comb', self.board.copy())
-		if anychange:
-			# have to find the differences and transition
-			# using fire
-			boardCopy = copy.deepcopy(board)
-			self.updateBoard(board)
-			print(self.board)
-			self.transitionBoard(boardCopy, board)
-		
-		#print(('STEP %d: activation...' % nstep))
-		anychange = self.acto.run() or anychange
-		self.gameLog('acto', self.board.copy())
-		if anychange:
-			boardCopy = copy.deepcopy(board)
-			self.updateBoard(board)
-			print(self.board)
-			self.transitionBoard(boardCopy, board)
+		self.animatePhase(board, [], 'comb', self.comb.run())
+		self.animatePhase(board, [], 'acto', self.acto.run())
 		
 		# dropping phase
 		return self.fillBoardAndAnimate(board, [])
@@ -594,37 +530,11 @@ class UltraGemGame(object):
 				if gemToDraw != EMPTY_SPACE:
 					self.WINDOWSURF.blit(self.GEMIMAGES[gemToDraw], self.BOARDRECTS[x][y])
 	
-	def scoring_function(self, events):
-		nspecial = [0, 0, 0]
-		ncombispecial_index = {22:0,42:1,44:2,51:3,52:4,54:5,55:6}
-		ncombispecial = [0, 0, 0, 0, 0, 0, 0]
-		nunlocked = 0
-		ndestroyed = 0
-		score = 0
-		for type, value in events:
-			if type == 'activated':
-				if value in (2,3):
-					nspecial[0] += 1
-				elif value == 4:
-					nspecial[1] += 1
-				elif value == 5:
-					nspecial[2] += 1
-				score += 10 * value
-			elif type == 'unlocked':
-				nunlocked += value
-			elif type == 'destroyed':
-				ndestroyed += value
-				score += value
-			elif type == 'combined':
-				ncombispecial[ncombispecial_index[value]] += 1
-		return [score, ndestroyed, nunlocked] + nspecial + ncombispecial
-
 	def drawScore(self, update=True):
 		lastscore = self.score
 		if update:
-			newevents = self.board.events[self.events_processed:]
-			newscore = self.scoring_function(newevents)
-			self.score = [a+b for a,b in zip(newscore, lastscore)]
+			self.score = self.board.events.scores()
+			newscore = [a-b for a,b in zip(self.score, lastscore)]
 			_, _, y, x = self.last_move
 			#print('new score:', newscore, x, y)
 			if newscore[0] > 0 and x is not None:
@@ -634,7 +544,6 @@ class UltraGemGame(object):
 				self.WINDOWSURF.blit(pointsSurf, pointsRect)
 				pygame.display.update()
 				self.FPSCLOCK.tick(SCOREFPS)
-			self.events_processed = len(self.board.events)
 		
 		done = self.score[self.goalid]
 		todo = self.goalvalue
@@ -827,7 +736,10 @@ My last moves were:
 		pygame.draw.rect(self.WINDOWSURF, HIGHLIGHTCOLOR, self.BOARDRECTS[x][y], 4)
 
 	def hintMove(self):
-		(fromj, fromi, toj, toi), score = self.possible_moves[0]
+		# the moves are shuffled; search the best listed first
+		moves = sorted(self.possible_moves, key=lambda move: -move[1])
+		search = LookaheadSearch(depth=3, beam=4, timelimit=HINTTIME)
+		fromj, fromi, toj, toi = search(self.board, moves)
 		for i in range(3):
 			x, y = fromi, fromj
 			pygame.draw.rect(self.WINDOWSURF, HINTCOLOR, self.BOARDRECTS[x][y], 4)